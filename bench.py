@@ -0,0 +1,172 @@
+#!/bin/python3
+"""
+Benchmark that runs several headless nodes on localhost and sends messages to them
+at a fixed rate. Reports the commit latency, throughput, rejected proposals
+and the bytes sent between the nodes.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from threading import Lock, Thread
+
+from main import Node
+
+
+class Benchmark:
+    def __init__(self, node_count, rate, duration, message_size, base_port, leader_mode=False):
+        self.rate = rate
+        self.duration = duration
+        self.message_size = message_size
+        addresses = [(f"127.0.0.1:{base_port + i}", f"node{i}") for i in range(node_count)]
+        self.nodes = [Node([peer for peer in addresses if peer[1] != nickname], nickname,
+                           history_dir=None, port=base_port + i, bind_host="127.0.0.1",
+                           headless=True, leader_mode=leader_mode)
+                      for i, (address, nickname) in enumerate(addresses)]
+
+        # Send times of the messages that are not committed yet
+        self.sent = {}
+        self.latencies = []
+        self.lock = Lock()
+        self.last_commit = None
+
+    def start(self):
+        for node in self.nodes:
+            # The nodes already know each other
+            node.start(join=False)
+            node.subscribe(lambda entry, node=node: self.collect(node, entry))
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+    def collect(self, node, entry):
+        """
+        Records the commit latency of the messages sent through this node.
+        """
+        if entry["sender"] != node.nickname:
+            return
+        now = time.monotonic()
+        key = entry["message"].split(" ", 1)[0]
+        with self.lock:
+            sent = self.sent.pop(key, None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+                self.last_commit = now
+
+    def client(self, node, rate, stop):
+        """
+        Sends messages to one node at the given rate until stop.
+        """
+        padding = "x" * self.message_size
+        interval = 1 / rate
+        next_send = time.monotonic()
+        sequence = 0
+        while next_send < stop:
+            time.sleep(max(0, next_send - time.monotonic()))
+            key = f"{node.nickname}-{sequence}"
+            with self.lock:
+                self.sent[key] = time.monotonic()
+            node.send(f"{key} {padding}")
+            sequence += 1
+            next_send += interval
+
+    def run(self, drain_timeout=10):
+        self.start()
+        start = time.monotonic()
+        stop = start + self.duration
+        clients = [Thread(target=self.client, args=[node, self.rate / len(self.nodes), stop],
+                          name=f"client-{node.nickname}")
+                   for node in self.nodes]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+        # Wait for the messages that are still being committed
+        deadline = time.monotonic() + drain_timeout
+        while self.sent and time.monotonic() < deadline:
+            time.sleep(0.05)
+        results = self.report(start)
+        self.stop()
+        return results
+
+    def report(self, start):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            elapsed = (self.last_commit or time.monotonic()) - start
+            uncommitted = len(self.sent)
+
+        def percentile(value):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * value))] * 1000, 3)
+
+        stats = sum((node.stats for node in self.nodes), Counter())
+        return {
+            "nodes": len(self.nodes),
+            "target_rate": self.rate,
+            "duration": self.duration,
+            "message_size": self.message_size,
+            "committed": len(latencies),
+            "uncommitted": uncommitted,
+            "messages_per_second": round(len(latencies) / elapsed, 3) if elapsed > 0 else None,
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p90": percentile(0.9),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1] * 1000, 3) if latencies else None,
+            },
+            "proposals": stats["proposals"],
+            "rejected": stats["rejected"],
+            "retries": stats["retries"],
+            "forwarded": stats["forwarded"],
+            "bytes_sent": stats["bytes_sent"],
+        }
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmark nodes running on localhost.")
+    parser.add_argument("--nodes", type=int, default=3, help="number of nodes")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="messages per second sent to all nodes together")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send messages")
+    parser.add_argument("--size", type=int, default=100, help="bytes of padding in a message")
+    # Below the ephemeral ports of Linux, which the connections between the
+    # nodes may already use when a node starts listening
+    parser.add_argument("--base-port", type=int, default=27000,
+                        help="the nodes listen to consecutive ports starting from this one")
+    parser.add_argument("--leader", action="store_true",
+                        help="propose through an elected leader of the nodes")
+    parser.add_argument("--json", metavar="FILE", help="write the results as json to FILE, - for stdout")
+    options = parser.parse_args(args[1:])
+
+    # Debug logging of every packet would dominate the results
+    logging.getLogger().setLevel(logging.WARNING)
+
+    benchmark = Benchmark(options.nodes, options.rate, options.duration, options.size,
+                          options.base_port, options.leader)
+    results = benchmark.run()
+
+    if options.json == "-":
+        print(json.dumps(results, indent=2))
+    else:
+        if options.json:
+            with open(options.json, "w") as file:
+                json.dump(results, file, indent=2)
+        latency = results["latency_ms"]
+        print(f"Committed {results['committed']} messages, {results['uncommitted']} not committed")
+        print(f"Throughput: {results['messages_per_second']} messages/s")
+        print(f"Latency ms: p50 {latency['p50']}, p90 {latency['p90']}, "
+              f"p99 {latency['p99']}, max {latency['max']}")
+        print(f"Proposals: {results['proposals']}, rejected {results['rejected']}, "
+              f"retries {results['retries']}, forwarded {results['forwarded']}")
+        print(f"Bytes sent: {results['bytes_sent']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
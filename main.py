@@ -1,41 +1,1061 @@
 #!/bin/python3
 
 from socket import (
-    AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR,
-    gethostname, gethostbyname, socket
+    AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR,
+    create_connection, gethostname, socket
 )
 import tty
 import termios
 import os
 import sys
+import signal
 import json
 import queue
+import re
 import logging
 import time
+import math
 import random
-from threading import Thread, Timer
-from json.decoder import JSONDecodeError
+import itertools
+import struct
+import asyncio
+import mmap
+import bisect
+import heapq
+import functools
+import uuid
+from collections import Counter, deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Condition, Event, Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import msgpack
+except ImportError:
+    # The compact encoding is optional, json is always available
+    msgpack = None
 
 APPLICATION_PORT = 65412
+# Seconds to wait for a tcp connection to a peer
+CONNECT_TIMEOUT = 3
+# Seconds to wait for a response to a single request
+REQUEST_TIMEOUT = 5
+# Pooled connections unused for this many seconds are closed
+IDLE_TIMEOUT = 60
+# Maximum number of connections to peers being opened at the same time
+CONNECT_WORKERS = 32
+# Maximum number of rooms fetching the history they have missed at the same
+# time
+FETCH_WORKERS = 4
+# Threads of the asyncio server that handle the room requests. The requests
+# of a room take its lock in turn, so a few threads serve many peers.
+ROOM_REQUEST_WORKERS = 8
+# Maximum number of requests waiting for a response from one peer. Further
+# requests are queued until a response arrives or they time out.
+PEER_WINDOW = 256
+# The terminal is redrawn at most once in this many seconds
+UI_FRAME_INTERVAL = 1 / 30
+# Number of latest messages the ui keeps for scrolling back
+SCROLLBACK_SIZE = 1000
+# Names of the keys sent by the terminal as escape sequences, without the
+# escape character. The cursor keys start with O in the application mode.
+KEY_SEQUENCES = {"[A": "up", "[B": "down", "[C": "right", "[D": "left",
+                 "OA": "up", "OB": "down", "OC": "right", "OD": "left",
+                 "[5~": "page_up", "[6~": "page_down"}
+ERROR_STYLE = "\033[1m\033[31m"
+INFO_STYLE = "\033[1m\033[90m"
+
+# Queued messages are proposed together as one batch of at most this many
+# messages or bytes
+MAX_BATCH_MESSAGES = 100
+MAX_BATCH_BYTES = 64 * 1024
+# Seconds to wait for more messages before proposing a batch
+BATCH_DELAY = 0.01
+# Number of our own batches that can be proposed at the same time
+PIPELINE_WINDOW = 4
+# Range of seconds to wait before proposing rejected batches again
+RETRY_DELAY = (0.1, 0.3)
+# Seconds a round that a majority has answered without deciding it waits
+# for the remaining votes before it is given up as rejected
+VOTE_TIMEOUT = 0.05
+# Maximum number of history entries sent in one response
+HISTORY_PAGE_SIZE = 1000
+# Number of the latest committed message ids remembered for dropping
+# messages that are committed again
+DEDUP_CACHE_SIZE = 10000
+# Maximum number of messages or forwarded batches waiting to be proposed in
+# a room, and of events waiting for the ui. 0 means no limit.
+OUTBOUND_QUEUE_SIZE = int(os.environ.get('OUTBOUND_QUEUE_SIZE') or 10000)
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE') or 10000)
+# What to do when a queue is full: "block" waits for space, "drop-oldest"
+# drops the oldest item and "coalesce" merges the item into the newest one,
+# or drops the oldest item if they can't be merged
+QUEUE_POLICIES = ("block", "drop-oldest", "coalesce")
+OUTBOUND_QUEUE_POLICY = os.environ.get('OUTBOUND_QUEUE_POLICY', "block")
+EVENT_QUEUE_POLICY = os.environ.get('EVENT_QUEUE_POLICY', "coalesce")
+# Messages per second accepted from each sender in the proposals and
+# forwards of the peers, no limit if not set. Short bursts of up to a
+# second's worth of messages are allowed.
+SENDER_RATE_LIMIT = float(os.environ.get('SENDER_RATE_LIMIT') or 0) or None
+# Room that every node joins, and the room of requests that don't name one
+DEFAULT_ROOM = "main"
+# Room names are also used as directory names of the history
+ROOM_NAME = re.compile(r"[\w-]{1,64}")
+# Requests that are handled by the room they name
+ROOM_REQUESTS = {"GET_HISTORY", "GET_SNAPSHOT", "PROPOSE", "ABORT", "COMMIT", "FORWARD",
+                 "REQUEST_VOTE", "LEADER"}
+
+# Seconds between the heartbeats sent to every member
+HEARTBEAT_INTERVAL = 0.5
+# A member is suspected once the phi of its missing heartbeat exceeds this
+PHI_THRESHOLD = 5
+# Number of latest heartbeat intervals the phi is estimated from
+PHI_WINDOW = 100
+# Seconds a member stays suspected before it is declared dead
+SUSPECT_TIMEOUT = 5
+# Seconds dead members are remembered, so that old gossip can't revive them
+DEAD_MEMBER_RETAIN = 60
+# Range of seconds without a heartbeat from the leader before a node starts
+# an election in leader mode
+ELECTION_TIMEOUT = (1.5, 3)
+# Member states, later ones win when the incarnations are equal
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+STATUS_RANK = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+
+# The history is stored on disk when HISTORY_DIR is set
+HISTORY_DIR = os.environ.get('HISTORY_DIR')
+# When to fsync the history: "always" after every commit, "interval" at most
+# once per FSYNC_INTERVAL seconds or "never" to leave it to the os
+HISTORY_FSYNC = os.environ.get('HISTORY_FSYNC', "always")
+FSYNC_INTERVAL = 1
+# A new history segment file is started when the current one reaches this size
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Each history record is the payload length followed by the json payload
+RECORD_HEADER = struct.Struct("!I")
+# The offset index of a segment has the file offset of each record
+INDEX_ENTRY = struct.Struct("!Q")
+
+# Older history is dropped once more than this many messages or bytes are
+# stored, or once it is older than this many seconds. Empty means no limit.
+HISTORY_RETAIN_COUNT = int(os.environ.get('HISTORY_RETAIN_COUNT') or 0) or None
+HISTORY_RETAIN_BYTES = int(os.environ.get('HISTORY_RETAIN_BYTES') or 0) or None
+HISTORY_RETAIN_AGE = float(os.environ.get('HISTORY_RETAIN_AGE') or 0) or None
+# A snapshot is taken and the history compacted after this many new messages
+SNAPSHOT_INTERVAL = 1000
+# Number of the latest messages included in a snapshot
+SNAPSHOT_MESSAGES = 100
+
+# Every packet is sent as a frame: payload length, payload encoding, payload
+FRAME_HEADER = struct.Struct("!IB")
+# Frames larger than this are treated as a protocol error
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Payloads smaller than this are joined with the header before sending
+SMALL_FRAME_SIZE = 64 * 1024
+
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+ENCODING_NAMES = {"json": ENCODING_JSON, "msgpack": ENCODING_MSGPACK}
+# Encodings this node can decode, the preferred one first
+SUPPORTED_ENCODINGS = ["msgpack", "json"] if msgpack else ["json"]
+
+# Upper bounds of the histogram buckets, in seconds and in messages
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Port of the local http endpoint serving the metrics in the Prometheus text
+# format, no endpoint if not set
+METRICS_PORT = int(os.environ.get('METRICS_PORT') or 0) or None
+# Counters of the votes for our proposals
+VOTE_COUNTERS = {"ack": "ack_votes", "reject": "reject_votes"}
+
 logger = logging.getLogger(__name__)
+# DEBUG logs every packet, which slows down a busy node
 logging.basicConfig(filename=os.environ.get('LOG_FILE', "chat.log"),
-                    level=logging.DEBUG, format="%(asctime)s - %(message)s")
+                    level=os.environ.get('LOG_LEVEL', "INFO").upper(),
+                    format="%(asctime)s - %(message)s")
+
+def encode_packet(data, encoding=ENCODING_JSON):
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def decode_packet(payload, encoding):
+    if encoding == ENCODING_MSGPACK:
+        if not msgpack:
+            raise ValueError("Received msgpack frame but msgpack isn't installed")
+        return msgpack.unpackb(payload)
+    if encoding == ENCODING_JSON:
+        return json.loads(payload)
+    raise ValueError(f"Unknown frame encoding {encoding}")
+
+def choose_encoding(offered):
+    """
+    Picks the first encoding from the offered list that we support.
+    """
+    for name in offered or []:
+        if name in SUPPORTED_ENCODINGS:
+            return name
+    return "json"
+
+def parse_address(address):
+    """
+    Splits a peer address of the form host or host:port.
+
+    Returns:
+    tuple: The host and the port.
+    """
+    host, _, port = address.partition(":")
+    return host, int(port) if port else APPLICATION_PORT
+
+def format_address(host, port):
+    """
+    Returns the address of a peer, the port is left out if it is the default.
+    """
+    return host if port == APPLICATION_PORT else f"{host}:{port}"
+
+def close_listener(listener):
+    """
+    Closes a listening socket. Closing alone doesn't wake up a thread that
+    is blocked in accept, so the socket is shut down first.
+    """
+    try:
+        listener.shutdown(SHUT_RDWR)
+    except OSError:
+        pass
+    listener.close()
+
+def frame_packet(data, encoding=ENCODING_JSON):
+    """
+    Encodes one packet.
+
+    Returns:
+    tuple: The frame header and the payload.
+    """
+    payload = encode_packet(data, encoding)
+    return FRAME_HEADER.pack(len(payload), encoding), payload
+
+def send_packet(socket, data, encoding=ENCODING_JSON):
+    """
+    Sends one packet as a length prefixed frame.
+
+    Returns:
+    int: Number of bytes written to the socket.
+    """
+    header, payload = frame_packet(data, encoding)
+    if len(payload) < SMALL_FRAME_SIZE:
+        socket.sendall(header + payload)
+    else:
+        # Avoid copying large payloads just to prepend the header
+        socket.sendall(header)
+        socket.sendall(payload)
+    return len(header) + len(payload)
+
+
+class PacketReader:
+    """
+    Incremental frame reader. Reads each frame straight into a buffer of the
+    exact frame size, so partial reads and frames of any size are handled
+    without extra copies.
+    """
+    def __init__(self, socket, metrics=None):
+        self.stream = socket.makefile("rb")
+        self.header = bytearray(FRAME_HEADER.size)
+        # The bytes received are counted in the metrics, if given
+        self.metrics = metrics
+
+    def read_exact(self, buffer):
+        view = memoryview(buffer)
+        received = 0
+        while received < len(buffer):
+            count = self.stream.readinto(view[received:])
+            if not count:
+                if received:
+                    raise ConnectionError("Connection closed in the middle of a frame")
+                return False
+            received += count
+        return True
+
+    def read(self):
+        """
+        Reads the next packet.
+
+        Returns:
+        dict: The decoded packet, or None if the connection was closed.
+
+        Raises:
+        ValueError: If the frame is invalid.
+        """
+        if not self.read_exact(self.header):
+            return None
+        length, encoding = FRAME_HEADER.unpack(self.header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes exceeds the size limit")
+        payload = bytearray(length)
+        if not self.read_exact(payload):
+            raise ConnectionError("Connection closed in the middle of a frame")
+        if self.metrics is not None:
+            self.metrics.count("bytes_received", FRAME_HEADER.size + length)
+        try:
+            return decode_packet(payload, encoding)
+        except ValueError:
+            logger.error("Invalid packet data: %r", bytes(payload[:200]))
+            raise
+
+    def close(self):
+        self.stream.close()
+
+    def __iter__(self):
+        while True:
+            packet = self.read()
+            if packet is None:
+                return
+            yield packet
+
+async def read_packet_async(reader, metrics=None):
+    """
+    Reads the next packet from an asyncio stream. The bytes received are
+    counted in the metrics, if given.
 
-def send_packet(socket, data):
-    socket.sendall(json.dumps(data).encode())
+    Returns:
+    dict: The decoded packet, or None if the connection was closed.
 
-def send_packet_to_peer(address, data):
-    with socket(AF_INET, SOCK_STREAM) as s:
-        s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        s.connect((address, APPLICATION_PORT))
-        send_packet(s, data)
-        data = s.recv(1024)
+    Raises:
+    ValueError: If the frame is invalid.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as exc:
+        if exc.partial:
+            raise ConnectionError("Connection closed in the middle of a frame") from exc
+        return None
+    length, encoding = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the size limit")
     try:
-        return json.loads(data)
-    except JSONDecodeError:
-        logger.error("Invalid response data: " + data)
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as exc:
+        raise ConnectionError("Connection closed in the middle of a frame") from exc
+    if metrics is not None:
+        metrics.count("bytes_received", FRAME_HEADER.size + length)
+    try:
+        return decode_packet(payload, encoding)
+    except ValueError:
+        logger.error("Invalid packet data: %r", payload[:200])
         raise
 
+async def send_packet_async(writer, data, encoding=ENCODING_JSON):
+    """
+    Sends one packet as a length prefixed frame to an asyncio stream.
+
+    Returns:
+    int: Number of bytes written to the stream.
+    """
+    header, payload = frame_packet(data, encoding)
+    writer.writelines((header, payload))
+    await writer.drain()
+    return len(header) + len(payload)
+
+def read_packets(socket, metrics=None):
+    """
+    Reads packets from the socket until the other end closes the connection.
+
+    Yields:
+    dict: The decoded packets.
+    """
+    reader = PacketReader(socket, metrics)
+    try:
+        yield from reader
+    finally:
+        reader.close()
+
+
+class BoundedQueue(queue.Queue):
+    """
+    Queue with a size limit and a policy for putting to a full queue, one of
+    QUEUE_POLICIES. The None that stops the consumer is never merged.
+    """
+    def __init__(self, limit, policy="block", merge=None, on_drop=None):
+        """
+        Args:
+        limit (int): Maximum number of items, 0 for no limit.
+        policy (str): What to do when the queue is full.
+        merge (function): Takes the newest item and the new one, and returns
+            them merged, or None if they can't be merged.
+        on_drop (function): Called with every dropped item.
+
+        Raises:
+        ValueError: If the policy is unknown.
+        """
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}")
+        super().__init__(limit if policy == "block" else 0)
+        self.limit = limit
+        self.policy = policy
+        self.merge = merge
+        self.on_drop = on_drop
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == "block" or not self.limit:
+            super().put(item, block, timeout)
+            return
+        dropped = None
+        with self.mutex:
+            if self._qsize() >= self.limit:
+                merged = None
+                if self.policy == "coalesce" and self.merge and None not in (item, self.queue[-1]):
+                    merged = self.merge(self.queue[-1], item)
+                if merged is not None:
+                    self.queue[-1] = merged
+                    return
+                dropped = self.queue.popleft()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        if dropped is not None and self.on_drop:
+            self.on_drop(dropped)
+
+
+def coalesce_batches(last, item):
+    """
+    Merges two queued items of senders, messages and message ids, unless the
+    result would be larger than a batch.
+    """
+    if len(last[1]) + len(item[1]) > MAX_BATCH_MESSAGES:
+        return None
+    return last[0] + item[0], last[1] + item[1], last[2] + item[2]
+
+
+def coalesce_events(last, event):
+    """
+    Replaces the newest ui event with a new one of the same type, for the
+    events of which only the latest matters.
+    """
+    if event["type"] == last["type"] and event["type"] in ("resize", "ack"):
+        return event
+    return None
+
+
+class RateLimiter:
+    """
+    Token bucket per sender. Each sender earns rate tokens per second, up to
+    a second's worth, and every committed message costs a token. Only the
+    commits are charged, because a proposal that fails to get a majority
+    would otherwise use up the tokens at some of the members and be
+    refused by the others on every retry.
+    """
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        # Tokens and the time they were counted, keyed by sender
+        self.buckets = {}
+        self.lock = Lock()
+
+    def tokens(self, sender, now):
+        available, counted = self.buckets.get(sender, (self.rate, now))
+        return min(self.rate, available + (now - counted) * self.rate)
+
+    def allow(self, senders):
+        """
+        Checks that every sender of a batch has tokens for its messages. A
+        batch larger than a second's worth of messages is allowed from a
+        full bucket, and the sender goes into debt when it is charged.
+
+        Args:
+        senders (list): Sender of each message.
+
+        Returns:
+        bool: False if some sender has sent too much.
+        """
+        now = self.clock()
+        with self.lock:
+            return all(self.tokens(sender, now) >= min(count, self.rate)
+                       for sender, count in Counter(senders).items())
+
+    def charge(self, senders):
+        """
+        Takes the tokens for the messages of a committed batch.
+        """
+        now = self.clock()
+        with self.lock:
+            for sender, count in Counter(senders).items():
+                self.buckets[sender] = (self.tokens(sender, now) - count, now)
+
+
+def copy_future(source, target):
+    """
+    Resolves target with the result or exception of the finished source,
+    unless target is already done.
+    """
+    if source.cancelled():
+        target.cancel()
+        return
+    error = source.exception()
+    if error:
+        fail_future(target, error)
+    else:
+        resolve_future(target, source.result())
+
+
+def resolve_future(future, result):
+    """
+    Resolves the future, unless it is already done or cancelled.
+    """
+    try:
+        future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def fail_future(future, error):
+    """
+    Fails the future, unless it is already done or cancelled.
+    """
+    try:
+        future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+class TcpTransport:
+    """
+    Sends requests to the peers over the pooled tcp connections. Sending
+    doesn't wait for the responses, the requests are multiplexed over the
+    connections and the scheduler fails the ones not answered in time, so
+    a hung peer doesn't hold up the requests to the other peers. Only
+    opening a connection blocks, and that is done in the connect threads
+    once per peer at a time.
+    """
+    def __init__(self, metrics=None, scheduler=None):
+        # Reusable connections to the other nodes
+        self.connections = ConnectionPool(metrics=metrics)
+        # Fails the requests that are not answered in time
+        self.scheduler = scheduler or Scheduler()
+        # Threads for opening the connections
+        self.executor = ThreadPoolExecutor(max_workers=CONNECT_WORKERS,
+                                           thread_name_prefix="connect")
+        # Connections being opened, keyed by peer address
+        self.connecting = {}
+        self.lock = Lock()
+
+    def submit(self, address, data, timeout=REQUEST_TIMEOUT):
+        """
+        Sends a request to a peer without waiting for the response.
+
+        Args:
+        address (str): Address of the peer.
+        data (dict): The request packet.
+        timeout (float): Seconds to wait for the response, including the
+        time to open the connection.
+
+        Returns:
+        Future: Resolves to the response packet. Cancelling it frees its
+        place in the send window of the connection.
+
+        Raises:
+        RuntimeError: If the transport has been closed.
+        """
+        response = Future()
+        self.send(address, data, response, retry=True)
+        expiry = self.scheduler.schedule(timeout, fail_future, response, FutureTimeoutError(
+            f"{address} didn't respond in {timeout} seconds"))
+        response.add_done_callback(lambda response: expiry.cancel())
+        return response
+
+    def send(self, address, data, response, retry):
+        connection = self.connections.cached(address)
+        if connection is None:
+            self.connect(address).add_done_callback(
+                lambda connecting: self.connected(connecting, data, response))
+        else:
+            self.send_on(connection, data, response, retry)
+
+    def connected(self, connecting, data, response):
+        if response.done():
+            # Timed out while connecting
+            return
+        error = connecting.exception()
+        if error:
+            fail_future(response, error)
+        else:
+            self.send_on(connecting.result(), data, response, retry=False)
+
+    def send_on(self, connection, data, response, retry):
+        try:
+            request = connection.submit(data)
+        except ConnectionError as exc:
+            # A stale pooled connection is replaced once before giving up
+            self.connections.discard(connection)
+            if retry:
+                self.send(connection.address, data, response, retry=False)
+            else:
+                fail_future(response, exc)
+            return
+        request.add_done_callback(lambda request: copy_future(request, response))
+        response.add_done_callback(lambda response: request.cancel())
+
+    def connect(self, address):
+        """
+        Opens a connection to a peer in a connect thread. Requests sent
+        while the connection is being opened share the same attempt.
+
+        Returns:
+        Future: Resolves to the connection.
+        """
+        with self.lock:
+            connecting = self.connecting.get(address)
+            if connecting is not None:
+                return connecting
+            connecting = self.executor.submit(self.connections.get, address)
+            self.connecting[address] = connecting
+        connecting.add_done_callback(lambda connecting: self.connect_done(address, connecting))
+        return connecting
+
+    def connect_done(self, address, connecting):
+        with self.lock:
+            if self.connecting.get(address) is connecting:
+                del self.connecting[address]
+
+    def request(self, address, data, timeout=REQUEST_TIMEOUT):
+        """
+        Sends a request to a peer and waits for the response.
+
+        Raises:
+        Exception: If the connection fails or the peer doesn't respond in time.
+        """
+        response = self.submit(address, data, timeout)
+        try:
+            return response.result(timeout)
+        except FutureTimeoutError:
+            response.cancel()
+            raise
+
+    def reset(self, address):
+        self.connections.reset(address)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.connections.close()
+
+
+class ScheduledCall:
+    """
+    A call waiting in the scheduler. Cancelled calls stay in the heap until
+    their deadline but are not run.
+    """
+    __slots__ = ("deadline", "function", "args", "cancelled")
+
+    def __init__(self, deadline, function, args):
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs delayed calls in a single thread instead of a thread per timer.
+    The calls are kept in a heap ordered by deadline, and they must return
+    quickly because the later calls wait for them.
+    """
+    def __init__(self):
+        self.heap = []
+        # Keeps the calls with the same deadline in scheduling order
+        self.sequence = itertools.count()
+        self.condition = Condition(Lock())
+        self.thread = None
+        self.stopped = False
+
+    def schedule(self, delay, function, *args):
+        """
+        Calls function with args after delay seconds.
+
+        Returns:
+        ScheduledCall: Handle for cancelling the call.
+        """
+        call = ScheduledCall(time.monotonic() + delay, function, args)
+        with self.condition:
+            if self.stopped:
+                return call
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="scheduler", daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (call.deadline, next(self.sequence), call))
+            if self.heap[0][2] is call:
+                # The thread is waiting for a later deadline
+                self.condition.notify()
+        return call
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.heap.clear()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.condition.wait(self.heap[0][0] - now if self.heap else None)
+                if self.stopped:
+                    return
+                call = heapq.heappop(self.heap)[2]
+            if call.cancelled:
+                continue
+            try:
+                call.function(*call.args)
+            except Exception:
+                logger.exception("Scheduled call failed")
+
+
+class Histogram:
+    """
+    Counts observed values into buckets, like a Prometheus histogram.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for the values over the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """
+        Returns:
+        dict: The cumulative counts of the buckets, the sum and the count.
+        """
+        with self.lock:
+            counts = list(itertools.accumulate(self.counts))
+            total = self.sum
+        return {"buckets": [[bound, count] for bound, count in zip(self.buckets, counts)],
+                "sum": total, "count": counts[-1]}
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of a node. The gauges are functions that
+    are called only when the metrics are read, and may return a dict of
+    values keyed by room.
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self.gauges = {}
+        # The counters are updated from the server, connection and proposer
+        # threads, and += on a Counter is not atomic
+        self.lock = Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS):
+        self.histograms[name] = Histogram(buckets)
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {"counters": counters,
+                "histograms": {name: histogram.snapshot()
+                               for name, histogram in self.histograms.items()},
+                "gauges": {name: function() for name, function in self.gauges.items()}}
+
+    def prometheus(self):
+        """
+        Returns:
+        str: The metrics in the Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for name, value in counters:
+            lines += [f"# TYPE chat_{name}_total counter", f"chat_{name}_total {value}"]
+        for name, histogram in sorted(self.histograms.items()):
+            snapshot = histogram.snapshot()
+            lines.append(f"# TYPE chat_{name} histogram")
+            for bound, count in snapshot["buckets"]:
+                lines.append(f'chat_{name}_bucket{{le="{bound}"}} {count}')
+            lines += [f'chat_{name}_bucket{{le="+Inf"}} {snapshot["count"]}',
+                      f"chat_{name}_sum {snapshot['sum']}",
+                      f"chat_{name}_count {snapshot['count']}"]
+        for name, function in sorted(self.gauges.items()):
+            value = function()
+            lines.append(f"# TYPE chat_{name} gauge")
+            if isinstance(value, dict):
+                lines += [f'chat_{name}{{room="{room}"}} {room_value}'
+                          for room, room_value in sorted(value.items())]
+            else:
+                lines.append(f"chat_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics of the server's node at /metrics.
+    """
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The default writes to stderr, which belongs to the ui
+        logger.debug("Metrics request: " + format, *args)
+
+
+class PeerConnection:
+    """
+    Long-lived connection to one peer. Every request is tagged with an id
+    which the peer copies to its response, so several requests can be in
+    flight over the same connection at the same time. The requests are
+    written by a thread of the connection, so sending never waits for a
+    peer that doesn't read.
+
+    At most PEER_WINDOW requests are in flight at a time, so that a slow
+    peer doesn't collect an unbounded backlog. The rest wait in the
+    connection until a response or a cancelled request frees a place.
+    """
+    def __init__(self, address, metrics=None):
+        self.address = address
+        # Metrics of the node, the bytes sent are counted in them if given
+        self.metrics = metrics
+        self.socket = create_connection(parse_address(address), timeout=CONNECT_TIMEOUT)
+        if self.socket.getsockname() == self.socket.getpeername():
+            # Connecting to a local port nobody listens on can pick the same
+            # port for our end, and the socket would keep the peer from
+            # binding to it
+            self.socket.close()
+            raise ConnectionRefusedError(f"Connection to {address} refused")
+        self.socket.settimeout(None)
+        self.lock = Condition(Lock())
+        # Futures of the requests in flight, keyed by request id
+        self.pending = {}
+        # Requests waiting for a place in the window, as futures and
+        # packets keyed by request id
+        self.waiting = {}
+        # Requests waiting to be written, notified through the lock
+        self.outbox = deque()
+        self.request_ids = itertools.count()
+        self.last_used = time.monotonic()
+        self.closed = False
+        # Requests are sent as json until the peer has agreed on an encoding
+        self.encoding = ENCODING_JSON
+
+        Thread(target=self.read_responses, name=f"connection-{address}", daemon=True).start()
+        Thread(target=self.write_requests, name=f"writer-{address}", daemon=True).start()
+
+        if SUPPORTED_ENCODINGS != ["json"]:
+            hello = self.submit({"type": "HELLO", "encodings": SUPPORTED_ENCODINGS})
+            hello.add_done_callback(self.set_encoding)
+
+    def set_encoding(self, hello):
+        if not hello.exception():
+            name = hello.result().get("encoding", "json")
+            self.encoding = ENCODING_NAMES.get(name, ENCODING_JSON)
+
+    def submit(self, data):
+        """
+        Sends a request to the peer.
+
+        Args:
+        data (dict): The request packet.
+
+        Returns:
+        Future: Resolves to the response packet, or fails if the connection
+        is closed before the response arrives. Cancelling it frees its place
+        in the window.
+
+        Raises:
+        ConnectionError: If the connection is closed.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.address} is closed")
+            request_id = next(self.request_ids)
+            self.last_used = time.monotonic()
+            if len(self.pending) < PEER_WINDOW:
+                self.send(request_id, future, data)
+                queued = False
+            else:
+                self.waiting[request_id] = (future, data)
+                queued = True
+        if queued and self.metrics is not None:
+            self.metrics.count("window_waits")
+        future.add_done_callback(lambda future: self.finish(request_id))
+        return future
+
+    def send(self, request_id, future, data):
+        """
+        Puts a request in flight. Must be called with the lock held.
+        """
+        self.pending[request_id] = future
+        self.outbox.append({**data, "id": request_id})
+        self.lock.notify()
+
+    def finish(self, request_id):
+        """
+        Forgets a request that has been answered, failed or cancelled, and
+        sends the next waiting request in its place.
+        """
+        with self.lock:
+            if self.waiting.pop(request_id, None) or self.pending.pop(request_id, None) is None:
+                return
+            while self.waiting and not self.closed:
+                next_id = next(iter(self.waiting))
+                future, data = self.waiting.pop(next_id)
+                if not future.done():
+                    self.send(next_id, future, data)
+                    return
+
+    def write_requests(self):
+        while True:
+            with self.lock:
+                while not self.outbox and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+                requests, self.outbox = self.outbox, deque()
+            try:
+                for request in requests:
+                    sent = send_packet(self.socket, request, self.encoding)
+                    if self.metrics is not None:
+                        self.metrics.count("bytes_sent", sent)
+            except OSError as exc:
+                self.close(exc)
+                return
+
+    def read_responses(self):
+        error = ConnectionError(f"Connection to {self.address} was closed")
+        try:
+            for response in read_packets(self.socket, self.metrics):
+                with self.lock:
+                    future = self.pending.get(response.pop("id", None))
+                if future:
+                    resolve_future(future, response)
+        except (OSError, ValueError) as exc:
+            error = exc
+        finally:
+            self.close(error)
+
+    def close(self, error=None):
+        """
+        Closes the connection and fails all requests still waiting for a response.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            futures = list(self.pending.values())
+            futures.extend(future for future, data in self.waiting.values())
+            self.pending, self.waiting = {}, {}
+            self.outbox.clear()
+            self.lock.notify()
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        for future in futures:
+            fail_future(future, error or ConnectionError(f"Connection to {self.address} was closed"))
+
+
+class ConnectionPool:
+    """
+    Keeps one reusable connection per peer address. Connections are opened
+    lazily, reopened after a failure and closed after being idle.
+    """
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, metrics=None):
+        self.idle_timeout = idle_timeout
+        self.metrics = metrics
+        self.connections = {}
+        self.lock = Lock()
+
+    def cached(self, address):
+        """
+        Returns the open connection to a peer, or None if there is none.
+        """
+        with self.lock:
+            self.evict_idle()
+            connection = self.connections.get(address)
+        if connection and not connection.closed:
+            return connection
+        return None
+
+    def get(self, address):
+        connection = self.cached(address)
+        if connection:
+            return connection
+
+        # Connect outside of the lock so that an unreachable peer doesn't
+        # block requests to the other peers.
+        connection = PeerConnection(address, self.metrics)
+        with self.lock:
+            existing = self.connections.get(address)
+            if existing and not existing.closed:
+                duplicate, connection = connection, existing
+            else:
+                duplicate = None
+                self.connections[address] = connection
+        if duplicate:
+            duplicate.close()
+        return connection
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for address, connection in list(self.connections.items()):
+            if connection.closed or now - connection.last_used > self.idle_timeout:
+                del self.connections[address]
+                connection.close()
+
+    def discard(self, connection):
+        with self.lock:
+            if self.connections.get(connection.address) is connection:
+                del self.connections[connection.address]
+        connection.close()
+
+    def reset(self, address):
+        """
+        Closes the connection to a peer, so that the next request opens a new
+        one instead of queueing behind requests that are stuck.
+        """
+        with self.lock:
+            connection = self.connections.pop(address, None)
+        if connection:
+            connection.close()
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for connection in connections.values():
+            connection.close()
+
 def hash_func(nickname):
     total = 0
     for letter in list(nickname):
@@ -43,210 +1063,2268 @@ def hash_func(nickname):
     return total
 
 
+@functools.lru_cache(maxsize=1024)
+def sender_color(sender):
+    return hash_func(sender) % 7
+
+def format_message(sender, content, width):
+    """
+    Wraps a chat message to lines of the given width. The lines after the
+    first one are indented to the start of the message text.
+
+    Returns:
+    list: The lines with the terminal color codes.
+    """
+    indent = len(sender) + 2
+    text_width = max(1, width - indent)
+    chunks = [content[start:start + text_width] for start in range(0, len(content), text_width)]
+    lines = [f"{' ' * indent}{chunk}" for chunk in chunks]
+    if lines:
+        lines[0] = f"\033[9{sender_color(sender)}m{sender}\033[0m: {chunks[0]}"
+    return lines
+
+def format_notice(style, content, width):
+    """
+    Wraps an info or error text to lines of the given width.
+    """
+    return [f"{style}{content[start:start + width]}\033[0m"
+            for start in range(0, len(content), max(1, width))]
+
+
+class ScrollbackEntry:
+    """
+    One message in the scrollback and its lines wrapped to the latest width.
+    """
+    def __init__(self, format, *args):
+        self.format = format
+        self.args = args
+        self.width = None
+        self.lines = None
+
+    def wrap(self, width):
+        if width != self.width:
+            self.lines = self.format(*self.args, width)
+            self.width = width
+        return self.lines
+
+
+class Scrollback:
+    """
+    Ring buffer of the latest messages shown in the ui. Messages are wrapped
+    only when they are shown, and only the visible ones are wrapped. The
+    total number of lines is kept up to date for the latest width, so that
+    scrolling doesn't wrap the whole buffer.
+    """
+    def __init__(self, capacity=SCROLLBACK_SIZE):
+        self.entries = deque(maxlen=capacity)
+        # Lines of all the entries wrapped to width, None until counted
+        self.width = None
+        self.total = 0
+
+    def add(self, format, *args):
+        entry = ScrollbackEntry(format, *args)
+        if self.width is not None:
+            if len(self.entries) == self.entries.maxlen:
+                # The oldest entry is dropped by the append
+                self.total -= len(self.entries[0].wrap(self.width))
+            self.total += len(entry.wrap(self.width))
+        self.entries.append(entry)
+        return entry
+
+    def lines(self, width, count, scroll=0):
+        """
+        Returns the count lines that end scroll lines above the newest line.
+        """
+        chunks = []
+        found = 0
+        for entry in reversed(self.entries):
+            if found >= count + scroll:
+                break
+            chunks.append(entry.wrap(width))
+            found += len(chunks[-1])
+        lines = [line for chunk in reversed(chunks) for line in chunk]
+        end = max(0, len(lines) - scroll)
+        return lines[max(0, end - count):end]
+
+    def line_count(self, width):
+        """
+        Returns the number of lines of all the entries. The entries are
+        wrapped again only when the width has changed.
+        """
+        if width != self.width:
+            self.total = sum(len(entry.wrap(width)) for entry in self.entries)
+            self.width = width
+        return self.total
+
+
+class MessageIds:
+    """
+    Ids of the latest committed messages. A ring buffer keeps them in commit
+    order and a set finds them in constant time. The oldest id is forgotten
+    first.
+    """
+    def __init__(self, capacity=DEDUP_CACHE_SIZE):
+        self.capacity = capacity
+        self.order = deque()
+        self.ids = set()
+
+    def add(self, message_id):
+        """
+        Returns:
+        bool: False if the id was already there.
+        """
+        if message_id in self.ids:
+            return False
+        if len(self.order) >= self.capacity:
+            self.ids.discard(self.order.popleft())
+        self.order.append(message_id)
+        self.ids.add(message_id)
+        return True
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+    def __len__(self):
+        return len(self.order)
+
+
+def read_escape_sequence(read):
+    """
+    Reads the rest of an escape sequence after the escape character.
+
+    Args:
+    read (function): Reads the given number of characters.
+
+    Returns:
+    tuple: The name of the key, or None for keys that the ui doesn't
+    handle, and the character read after a lone escape, or None.
+    """
+    sequence = read(1)
+    if sequence == "O":
+        sequence += read(1)
+    elif sequence == "[":
+        # Parameters are followed by one final character from @ to ~
+        while True:
+            char = read(1)
+            sequence += char
+            if not char or "@" <= char <= "~":
+                break
+    else:
+        # Not a sequence, like escape pressed before another key
+        return None, sequence or None
+    return KEY_SEQUENCES.get(sequence), None
+
+
 class UserInterface:
     def __init__(self, event_queue, send_message, nickname):
         self.buffer = ""
         self.cursor = 0
+        # Number of lines scrolled up from the newest line
         self.scroll = 0
-        self.content = []
+        self.scrollback = Scrollback()
         self.event_queue = event_queue
         self.send_message = send_message
         self.exited = False
         self.nickname = nickname
 
+        # Cached terminal size, refreshed when the terminal is resized
+        self.size = None
+        # What has changed since the last frame
+        self.new_lines = 0
+        self.footer_changed = False
+        self.redraw_needed = True
+        self.last_frame = 0
+
+    def watch_terminal_size(self):
+        """
+        Caches the terminal size and refreshes it when the terminal is
+        resized. Signal handlers can only be set from the main thread.
+        """
+        self.size = os.get_terminal_size()
+        if hasattr(signal, "SIGWINCH"):
+            signal.signal(signal.SIGWINCH,
+                          lambda signum, frame: self.event_queue.put({"type": "resize"}))
+
+    @property
+    def message_lines(self):
+        # The last two lines are for the footer
+        return self.size.lines - 2
+
     def print_footer(self):
-        size = os.get_terminal_size()
-        sys.stdout.write(f"\033[{size.lines};1H")
+        sys.stdout.write(f"\033[{self.size.lines};1H\033[2K")
         prefix = f"{self.nickname}: "
         sys.stdout.write(prefix + self.buffer)
-        sys.stdout.write(f"\033[{size.lines};{self.cursor + len(prefix) + 1}H")
+        sys.stdout.write(f"\033[{self.size.lines};{self.cursor + len(prefix) + 1}H")
+
+    def print_messages(self):
+        # Only the message lines scroll, the footer stays in place
+        sys.stdout.write(f"\033[1;{self.message_lines}r\033[2J")
+        lines = self.scrollback.lines(self.size.columns, self.message_lines, self.scroll)
+        offset = self.message_lines - len(lines)
+        for index, line in enumerate(lines):
+            sys.stdout.write(f"\033[{index + offset + 1};1H")
+            sys.stdout.write(line)
+
+    def print_new_lines(self):
+        """
+        Scrolls the message lines up and prints the new lines at the bottom.
+        """
+        for line in self.scrollback.lines(self.size.columns, min(self.new_lines, self.message_lines)):
+            sys.stdout.write(f"\033[{self.message_lines};1H\n\033[2K{line}")
+
+    def render(self):
+        """
+        Draws the changes since the last frame.
+        """
+        if self.redraw_needed:
+            self.print_messages()
+            self.footer_changed = True
+        elif self.new_lines:
+            self.print_new_lines()
+            self.footer_changed = True
+        if self.footer_changed:
+            self.print_footer()
         sys.stdout.flush()
+        self.redraw_needed = False
+        self.new_lines = 0
+        self.footer_changed = False
+        self.last_frame = time.monotonic()
+
+    def run(self):
+        if os.name == 'nt':
+            self.run_plain()
+        else:
+            self.run_fancy()
+
+    def run_input_listener(self):
+        """
+        Reads the keys from stdin. The escape sequences of the special keys
+        are read whole here and queued as one key event, so that the ui
+        thread never reads stdin.
+        """
+        try:
+            while not self.exited:
+                new_char = sys.stdin.read(1)
+                if not new_char:
+                    # Stdin was closed, exit like with ctrl-d
+                    self.event_queue.put({"type": 'input', "char": "\x04"})
+                    break
+                if new_char == "\033":
+                    name, new_char = read_escape_sequence(sys.stdin.read)
+                    if name:
+                        self.event_queue.put({"type": "key", "name": name})
+                    if not new_char:
+                        continue
+                self.event_queue.put({"type": 'input', "char": new_char})
+        finally:
+            self.exited = True
+
+    def next_events(self):
+        """
+        Waits for the next event and collects the events that arrive before
+        the next frame, so that a burst of events is drawn only once.
+        """
+        events = [self.event_queue.get()]
+        time.sleep(max(0, self.last_frame + UI_FRAME_INTERVAL - time.monotonic()))
+        while True:
+            try:
+                events.append(self.event_queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def handle_event(self, event):
+        """
+        Updates the ui state for one event.
+
+        Returns:
+        bool: False if the user wants to exit.
+        """
+        if event["type"] == "input":
+            self.footer_changed = True
+            new_char = event["char"]
+            if ord(new_char) == 3:
+                raise KeyboardInterrupt()
+            elif ord(new_char) == 4:
+                return False
+            elif ord(new_char) == 13:
+                if self.buffer.strip() == "\\exit":
+                    return False
+                self.send_message(self.buffer)
+                self.buffer = ""
+                self.cursor = 0
+            elif ord(new_char) == 127:
+                self.buffer = self.buffer[0:self.cursor - 1] + self.buffer[self.cursor:]
+                self.cursor = max(0, self.cursor - 1)
+            else:
+                self.buffer += new_char
+                self.cursor += 1
+        elif event["type"] == "key":
+            self.footer_changed = True
+            if event["name"] == "left":
+                self.cursor = max(0, self.cursor - 1)
+            elif event["name"] == "right":
+                self.cursor = min(len(self.buffer), self.cursor + 1)
+            elif event["name"] == "up":
+                self.scroll_by(1)
+            elif event["name"] == "down":
+                self.scroll_by(-1)
+            elif event["name"] == "page_up":
+                self.scroll_by(self.message_lines)
+            elif event["name"] == "page_down":
+                self.scroll_by(-self.message_lines)
+        elif event["type"] == "resize":
+            self.size = os.get_terminal_size()
+            self.redraw_needed = True
+        elif event["type"] == "error":
+            self.add_lines(format_notice, ERROR_STYLE, event["content"])
+        elif event["type"] == "info":
+            self.add_lines(format_notice, INFO_STYLE, event["content"])
+        elif event["type"] == "user_message":
+            self.add_lines(format_message, event['sender'], event['content'])
+        return True
+
+    def add_lines(self, format, *args):
+        count = len(self.scrollback.add(format, *args).wrap(self.size.columns))
+        if self.scroll:
+            # Keep showing the same lines while scrolled up
+            self.scroll += count
+        else:
+            self.new_lines += count
+
+    def scroll_by(self, count):
+        total = self.scrollback.line_count(self.size.columns)
+        scroll = min(max(0, self.scroll + count), max(0, total - self.message_lines))
+        if scroll != self.scroll:
+            self.scroll = scroll
+            self.redraw_needed = True
+
+    def run_fancy(self):
+        try:
+            print("\033[?1049h")
+            tty_attrs = termios.tcgetattr(sys.stdin)
+            tty.setraw(sys.stdin)
+            if not self.size:
+                self.size = os.get_terminal_size()
+            self.render()
+
+            thread = Thread(target=self.run_input_listener, name="input")
+            thread.start()
+
+            while not self.exited:
+                if not all(self.handle_event(event) for event in self.next_events()):
+                    break
+                self.render()
+
+        except Exception as exc:
+            logger.exception(exc)
+            raise exc
+        finally:
+            self.exited = True
+            sys.stdout.write("\033[r\033[0m\033[?1049l")
+            sys.stdout.flush()
+            termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, tty_attrs)
+            os._exit(0)
+
+    def run_plain(self):
+        """
+        The fallback ui for windows
+        """
+        try:
+            thread = Thread(target=self.plain_events, name="events")
+            thread.start()
+            while True:
+                message = input()
+                if message.strip() == "\\exit":
+                    break
+                self.send_message(message)
+        except Exception as exc:
+            logger.exception(exc)
+            self.exited = True
+        finally:
+            os._exit(0)
+
+    def plain_events(self):
+        while not self.exited:
+            event = self.event_queue.get()
+
+            if event["type"] == "error":
+                print(ERROR_STYLE + event["content"] + "\033[0m")
+            elif event["type"] == "info":
+                print(event["content"])
+            elif event["type"] == "user_message":
+                size = os.get_terminal_size()
+                for line in format_message(event['sender'], event['content'], size.columns):
+                    print(line)
+
+
+class MessageLog:
+    """
+    Committed messages in index order. The indices are consecutive, so an
+    entry is found directly by its offset from the first stored index.
+    """
+    def __init__(self, first_index=0):
+        self.reset(first_index)
+
+    def reset(self, first_index):
+        """
+        Drops all entries. The next appended entry has the given index.
+        """
+        self.first_index = first_index
+        self.entries = []
+        # Size and append time of each entry, for the retention limits
+        self.sizes = []
+        self.times = []
+        self.size = 0
+
+    @property
+    def next_index(self):
+        return self.first_index + len(self.entries)
+
+    def append(self, index, sender, message, message_id=None):
+        if index != self.next_index:
+            raise ValueError(f"Expected message index {self.next_index}, got {index}")
+        entry = {"index": index, "sender": sender, "message": message}
+        if message_id is not None:
+            entry["id"] = message_id
+        self.entries.append(entry)
+        self.sizes.append(len(message.encode()))
+        self.times.append(time.time())
+        self.size += self.sizes[-1]
+
+    def get(self, index):
+        """
+        Returns the entry with the given index, or None if it isn't stored.
+        """
+        if self.first_index <= index < self.next_index:
+            return self.entries[index - self.first_index]
+        return None
+
+    def read(self, from_index, limit):
+        """
+        Returns at most limit entries starting from the given index.
+        """
+        start = max(from_index, self.first_index) - self.first_index
+        return self.entries[start:start + limit]
+
+    def compact(self, count=None, size=None, age=None):
+        """
+        Drops the oldest entries that are over any of the retention limits.
+
+        Args:
+        count (int): Number of entries to keep.
+        size (int): Number of message bytes to keep.
+        age (float): Seconds to keep the entries.
+        """
+        dropped = 0
+        oldest = time.time() - age if age else None
+        while dropped < len(self.entries) and (
+                count and len(self.entries) - dropped > count
+                or size and self.size > size
+                or oldest and self.times[dropped] < oldest):
+            self.size -= self.sizes[dropped]
+            dropped += 1
+        if dropped:
+            del self.entries[:dropped], self.sizes[:dropped], self.times[:dropped]
+            self.first_index += dropped
+
+    def save_snapshot(self, snapshot):
+        pass
+
+    def load_snapshot(self):
+        return None
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+class Segment:
+    """
+    One file of the on-disk history and its offset index. Reads go through
+    a memory map of the file, so the entries are never kept in memory.
+    """
+    def __init__(self, directory, first_index):
+        self.first_index = first_index
+        path = os.path.join(directory, f"{first_index:020d}")
+        self.log = open(path + ".log", "a+b", buffering=0)
+        self.index = open(path + ".idx", "a+b", buffering=0)
+        self.log_map = None
+        self.index_map = None
+        self.recover()
+
+    def recover(self):
+        """
+        Drops a partially written record at the end of the segment and
+        indexes the records written after the last index entry.
+        """
+        log_size = os.fstat(self.log.fileno()).st_size
+        count = os.fstat(self.index.fileno()).st_size // INDEX_ENTRY.size
+        position = 0
+        while count:
+            self.index.seek((count - 1) * INDEX_ENTRY.size)
+            offset, = INDEX_ENTRY.unpack(self.index.read(INDEX_ENTRY.size))
+            end = self.record_end(offset, log_size)
+            if end is not None:
+                position = end
+                break
+            count -= 1
+        self.index.truncate(count * INDEX_ENTRY.size)
+
+        # Only the tail that is missing from the index is read again
+        offsets = []
+        while (end := self.record_end(position, log_size)) is not None:
+            offsets.append(position)
+            position = end
+        self.log.truncate(position)
+        self.index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+        self.count = count + len(offsets)
+        self.size = position
+
+    def record_end(self, offset, log_size):
+        if offset + RECORD_HEADER.size > log_size:
+            return None
+        self.log.seek(offset)
+        length, = RECORD_HEADER.unpack(self.log.read(RECORD_HEADER.size))
+        end = offset + RECORD_HEADER.size + length
+        return end if end <= log_size else None
+
+    def append(self, payload):
+        self.log.write(RECORD_HEADER.pack(len(payload)) + payload)
+        self.index.write(INDEX_ENTRY.pack(self.size))
+        self.size += RECORD_HEADER.size + len(payload)
+        self.count += 1
+
+    def get(self, position):
+        """
+        Reads the record at the given position in this segment.
+        """
+        index_end = (position + 1) * INDEX_ENTRY.size
+        if not self.index_map or len(self.index_map) < index_end:
+            self.index_map = self.remap(self.index_map, self.index)
+        offset, = INDEX_ENTRY.unpack_from(self.index_map, position * INDEX_ENTRY.size)
+
+        if not self.log_map or len(self.log_map) < offset + RECORD_HEADER.size:
+            self.log_map = self.remap(self.log_map, self.log)
+        length, = RECORD_HEADER.unpack_from(self.log_map, offset)
+        start = offset + RECORD_HEADER.size
+        if len(self.log_map) < start + length:
+            self.log_map = self.remap(self.log_map, self.log)
+        return json.loads(self.log_map[start:start + length])
+
+    def remap(self, old_map, file):
+        # The map only covers the file as it was, appends need a new one
+        if old_map:
+            old_map.close()
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def sync(self):
+        os.fsync(self.log.fileno())
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        for file_map in (self.log_map, self.index_map):
+            if file_map:
+                file_map.close()
+        self.log.close()
+        self.index.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.log.name)
+        os.remove(self.index.name)
+
+    def modified(self):
+        """
+        Returns the time of the latest append to the segment.
+        """
+        return os.fstat(self.log.fileno()).st_mtime
+
+
+class SegmentedLog:
+    """
+    Durable history with the same interface as MessageLog. The messages are
+    appended to segment files in a directory, and a restarted node continues
+    from the messages already on disk.
+    """
+    def __init__(self, directory, fsync=HISTORY_FSYNC, segment_size=SEGMENT_SIZE):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy {fsync}")
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.last_sync = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+        first_indices = sorted(int(name[:-len(".log")]) for name in os.listdir(directory)
+                               if name.endswith(".log"))
+        self.segments = [Segment(directory, first_index) for first_index in first_indices]
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+        # First indices of the segments, for finding the segment of an entry
+        self.first_indices = [segment.first_index for segment in self.segments]
+
+    def reset(self, first_index):
+        """
+        Removes all entries. The next appended entry has the given index.
+        """
+        for segment in self.segments:
+            segment.remove()
+        self.segments = [Segment(self.directory, first_index)]
+        self.first_indices = [first_index]
+
+    @property
+    def first_index(self):
+        return self.segments[0].first_index
+
+    @property
+    def next_index(self):
+        return self.segments[-1].first_index + self.segments[-1].count
+
+    def append(self, index, sender, message, message_id=None):
+        if index != self.next_index:
+            raise ValueError(f"Expected message index {self.next_index}, got {index}")
+        if self.segments[-1].size >= self.segment_size:
+            self.rotate()
+        entry = {"index": index, "sender": sender, "message": message}
+        if message_id is not None:
+            entry["id"] = message_id
+        self.segments[-1].append(json.dumps(entry, separators=(",", ":")).encode())
+
+    def rotate(self):
+        self.segments[-1].sync()
+        self.segments.append(Segment(self.directory, self.next_index))
+        self.first_indices.append(self.next_index)
+
+    def compact(self, count=None, size=None, age=None):
+        """
+        Removes the oldest segments that only have entries over the retention
+        limits. The segment being appended to is always kept.
+
+        Args:
+        count (int): Number of entries to keep.
+        size (int): Number of bytes to keep.
+        age (float): Seconds to keep the entries.
+        """
+        total_size = sum(segment.size for segment in self.segments)
+        oldest = time.time() - age if age else None
+        while len(self.segments) > 1:
+            segment = self.segments[0]
+            if not (count and len(self) - segment.count >= count
+                    or size and total_size - segment.size >= size
+                    or oldest and segment.modified() < oldest):
+                break
+            total_size -= segment.size
+            segment.remove()
+            del self.segments[0], self.first_indices[0]
+
+    def save_snapshot(self, snapshot):
+        path = os.path.join(self.directory, "snapshot.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+
+    def load_snapshot(self):
+        """
+        Returns the snapshot saved before the restart, or None.
+        """
+        try:
+            with open(os.path.join(self.directory, "snapshot.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, index):
+        """
+        Returns the entry with the given index, or None if it isn't stored.
+        """
+        if not self.first_index <= index < self.next_index:
+            return None
+        segment = self.segments[bisect.bisect_right(self.first_indices, index) - 1]
+        return segment.get(index - segment.first_index)
+
+    def read(self, from_index, limit):
+        """
+        Returns at most limit entries starting from the given index.
+        """
+        start = max(from_index, self.first_index)
+        return [self.get(index) for index in range(start, min(start + limit, self.next_index))]
+
+    def sync(self):
+        """
+        Writes the appended entries to disk according to the fsync policy.
+        """
+        now = time.monotonic()
+        if self.fsync == "always" or (self.fsync == "interval"
+                                      and now - self.last_sync >= FSYNC_INTERVAL):
+            self.segments[-1].sync()
+            self.last_sync = now
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def __len__(self):
+        return self.next_index - self.first_index
+
+    def __iter__(self):
+        for index in range(self.first_index, self.next_index):
+            yield self.get(index)
+
+
+class FailureDetector:
+    """
+    Phi accrual failure detector of one member. Phi grows with the time since
+    the last heartbeat, relative to the mean of the recent intervals, assuming
+    the intervals are exponentially distributed.
+    """
+    def __init__(self, now, interval=HEARTBEAT_INTERVAL, window=PHI_WINDOW):
+        self.intervals = deque([interval], maxlen=window)
+        self.total = interval
+        self.last = now
+
+    def heartbeat(self, now):
+        if len(self.intervals) == self.intervals.maxlen:
+            self.total -= self.intervals[0]
+        interval = now - self.last
+        self.intervals.append(interval)
+        self.total += interval
+        self.last = now
+
+    def phi(self, now):
+        mean = max(self.total / len(self.intervals), 1e-3)
+        return (now - self.last) / mean * math.log10(math.e)
+
+
+class Member:
+    """
+    Another node and what we know about its state.
+    """
+    def __init__(self, address, nickname, incarnation, status, now, rooms=None):
+        self.address = address
+        self.nickname = nickname
+        self.rooms = frozenset(rooms or [DEFAULT_ROOM])
+        # Increased only by the member itself to refute its suspicion
+        self.incarnation = incarnation
+        self.status = status
+        self.changed = now
+        self.detector = FailureDetector(now)
+        # True while a heartbeat is waiting for its response
+        self.pinging = False
+
+    def gossip(self):
+        return {"address": self.address, "nickname": self.nickname,
+                "incarnation": self.incarnation, "status": self.status,
+                "rooms": sorted(self.rooms)}
+
+
+class Membership:
+    """
+    The other nodes of the chat and whether they are alive. Failures are
+    detected from heartbeats, and the states are spread by gossiping the
+    whole member list with every heartbeat. Every change increases the
+    version, so the live peers form a consistent view until the next change.
+    """
+    def __init__(self, nickname, on_change=None, clock=time.monotonic):
+        self.nickname = nickname
+        # Returns the current time in seconds, for the failure detection
+        self.clock = clock
+        # A restarted node is newer than anything said about its earlier run
+        self.incarnation = int(time.time())
+        # Rooms we have joined, spread with our heartbeats
+        self.rooms = frozenset([DEFAULT_ROOM])
+        self.members = {}
+        self.version = 0
+        self.on_change = on_change
+        self.lock = Lock()
+        # Views of the current version, keyed by room
+        self.cached_version = None
+        self.cached_views = {}
+
+    def view(self, room=None):
+        """
+        Args:
+        room (str): Only the members of this room, all members by default.
+
+        Returns:
+        tuple: The version and the addresses and nicknames of the members that
+        are not dead.
+        """
+        with self.lock:
+            if self.cached_version != self.version:
+                self.cached_version = self.version
+                self.cached_views = {}
+            view = self.cached_views.get(room)
+            if view is None:
+                peers = frozenset((member.address, member.nickname)
+                                  for member in self.members.values()
+                                  if member.status != DEAD and (room is None or room in member.rooms))
+                view = self.cached_views[room] = (self.version, peers)
+            return view
+
+    def join_room(self, room):
+        with self.lock:
+            if room not in self.rooms:
+                self.rooms = self.rooms | {room}
+                # The members take our room list only from a newer incarnation
+                self.incarnation += 1
+
+    def set_rooms(self, member, rooms):
+        """
+        Must be called with the lock held.
+        """
+        rooms = frozenset(rooms or [DEFAULT_ROOM])
+        if rooms != member.rooms:
+            member.rooms = rooms
+            self.version += 1
+
+    def peers(self):
+        return self.view()[1]
+
+    def gossip(self):
+        with self.lock:
+            return [member.gossip() for member in self.members.values()]
+
+    def set_status(self, member, status, now):
+        """
+        Must be called with the lock held.
+        """
+        if member.status == status:
+            return
+        previous = member.status
+        member.status = status
+        member.changed = now
+        if status == ALIVE:
+            # Give the member a fresh start instead of suspecting it again
+            member.detector = FailureDetector(now)
+        self.version += 1
+        logger.info("Member %s is %s, membership version %d", member.nickname, status, self.version)
+        if self.on_change:
+            self.on_change(member.nickname, previous, status)
+
+    def add(self, address, nickname, incarnation=0, rooms=None):
+        """
+        Adds a node that joined the chat through us.
+        """
+        if nickname == self.nickname:
+            return
+        now = self.clock()
+        with self.lock:
+            # The node may have restarted at the address with another nickname
+            for other in [m for m in self.members.values()
+                          if m.address == address and m.nickname != nickname]:
+                del self.members[other.nickname]
+                self.version += 1
+            member = self.members.get(nickname)
+            if member is None:
+                self.members[nickname] = Member(address, nickname, incarnation, ALIVE, now, rooms)
+                self.version += 1
+                return
+            if member.address != address:
+                member.address = address
+                self.version += 1
+            if incarnation >= member.incarnation:
+                member.incarnation = incarnation
+                self.set_rooms(member, rooms)
+            self.set_status(member, ALIVE, now)
+
+    def merge(self, entries):
+        """
+        Merges the member list gossiped by another node. A newer incarnation
+        wins, and on the same incarnation the more severe state wins.
+        """
+        now = self.clock()
+        with self.lock:
+            for entry in entries or []:
+                nickname = entry.get("nickname")
+                incarnation = entry.get("incarnation", 0)
+                status = entry.get("status")
+                if status not in STATUS_RANK:
+                    continue
+                if nickname == self.nickname:
+                    if status != ALIVE and incarnation >= self.incarnation:
+                        # Refute the suspicion, the new incarnation spreads
+                        # with our heartbeats
+                        self.incarnation = incarnation + 1
+                        logger.info("Refuting %s state with incarnation %d", status, self.incarnation)
+                    continue
+                member = self.members.get(nickname)
+                if member is None:
+                    if status != DEAD:
+                        self.members[nickname] = Member(entry.get("address"), nickname,
+                                                        incarnation, status, now,
+                                                        entry.get("rooms"))
+                        self.version += 1
+                    continue
+                if incarnation > member.incarnation:
+                    self.set_rooms(member, entry.get("rooms"))
+                if ((incarnation, STATUS_RANK[status])
+                        > (member.incarnation, STATUS_RANK[member.status])):
+                    member.incarnation = incarnation
+                    if status != ALIVE or self.responsive(member, now):
+                        self.set_status(member, status, now)
+
+    def responsive(self, member, now):
+        """
+        Whether our own heartbeats don't contradict a claim that the member
+        is alive. A node that can send but not answer stays suspected.
+        Must be called with the lock held.
+        """
+        return member.detector.phi(now) <= PHI_THRESHOLD
+
+    def refresh(self, nickname, incarnation, rooms=None, heartbeat=False):
+        """
+        Records a message from a member. A response to our heartbeat proves
+        it is alive, other messages only if they have a newer incarnation.
+
+        Args:
+        rooms (list): Rooms the member has joined, if the message tells them.
+        heartbeat (bool): Whether the message is a response to our heartbeat.
+        """
+        now = self.clock()
+        with self.lock:
+            member = self.members.get(nickname)
+            if member is None:
+                return
+            if rooms is not None and incarnation >= member.incarnation:
+                self.set_rooms(member, rooms)
+            newer = incarnation > member.incarnation
+            member.incarnation = max(member.incarnation, incarnation)
+            if heartbeat:
+                member.pinging = False
+                member.detector.heartbeat(now)
+                self.set_status(member, ALIVE, now)
+            elif newer and self.responsive(member, now):
+                self.set_status(member, ALIVE, now)
+
+    def failed(self, nickname, dead=False):
+        """
+        Suspects a member after a failed request, or declares it dead if it
+        refused the connection.
+        """
+        now = self.clock()
+        with self.lock:
+            member = self.members.get(nickname)
+            if member is None:
+                return
+            member.pinging = False
+            if dead:
+                self.set_status(member, DEAD, now)
+            elif member.status == ALIVE:
+                self.set_status(member, SUSPECT, now)
+
+    def check(self):
+        """
+        Suspects the members whose heartbeats are late and declares the ones
+        suspected for too long dead.
+
+        Returns:
+        list: Addresses and nicknames of the members to send a heartbeat to.
+        """
+        now = self.clock()
+        targets = []
+        with self.lock:
+            for member in list(self.members.values()):
+                if member.status == ALIVE and member.detector.phi(now) > PHI_THRESHOLD:
+                    self.set_status(member, SUSPECT, now)
+                elif member.status == SUSPECT and now - member.changed > SUSPECT_TIMEOUT:
+                    self.set_status(member, DEAD, now)
+                elif member.status == DEAD and now - member.changed > DEAD_MEMBER_RETAIN:
+                    del self.members[member.nickname]
+                    self.version += 1
+                    continue
+                # Dead members are pinged too, so that both sides of a healed
+                # partition find each other again
+                if not member.pinging:
+                    member.pinging = True
+                    targets.append((member.address, member.nickname))
+        return targets
+
+
+class Proposal:
+    """
+    One of our own batches and the votes for its current proposal round.
+    In leader mode the batch has messages forwarded by the other members.
+    """
+    def __init__(self, messages, senders, ids, clock=time.monotonic):
+        self.messages = messages
+        # Sender and id of each message
+        self.senders = senders
+        self.ids = ids
+        # For the latency metrics
+        self.clock = clock
+        self.created = clock()
+        self.round_started = None
+        # First index of the batch, None while waiting to be proposed
+        self.index = None
+        self.id = None
+        # Votes from earlier rounds of the same batch are ignored
+        self.round = 0
+        self.peer_count = 0
+        self.unanswered = 0
+        self.acks = 0
+        self.rejects = 0
+        # True or False once the majority has decided the round
+        self.accepted = None
+
+    def start_round(self, index, proposal_id, peer_count):
+        self.round_started = self.clock()
+        self.index = index
+        self.id = proposal_id
+        self.round += 1
+        self.peer_count = peer_count
+        self.unanswered = peer_count
+        self.acks = 0
+        self.rejects = 0
+        self.accepted = None
+
+    def add_vote(self, value):
+        """
+        Counts one vote, None for a peer that didn't answer.
+
+        Returns:
+        bool: True if the vote decided the round.
+        """
+        self.unanswered -= 1
+        if value == "ack":
+            self.acks += 1
+        elif value == "reject":
+            self.rejects += 1
+        return self.decide()
+
+    def decide(self):
+        """
+        Decides the round as soon as the acks form a majority or a majority
+        is no longer possible.
+        """
+        majority = self.peer_count / 2
+        if self.acks > majority:
+            self.accepted = True
+        elif self.acks + self.unanswered <= majority:
+            self.accepted = False
+        return self.accepted is not None
+
+    def reset(self):
+        self.index = None
+        self.round += 1
+        self.accepted = None
+
+    def drop_committed(self, committed_ids):
+        """
+        Removes the messages that have already been committed, for example
+        by a leader that took them before our forward timed out.
+
+        Returns:
+        bool: True if some messages are left.
+        """
+        if any(message_id in committed_ids for message_id in self.ids):
+            kept = [i for i, message_id in enumerate(self.ids) if message_id not in committed_ids]
+            self.messages = [self.messages[i] for i in kept]
+            self.senders = [self.senders[i] for i in kept]
+            self.ids = [self.ids[i] for i in kept]
+        return bool(self.messages)
+
+
+class Room:
+    """
+    One chat room with its own log. Rooms commit their batches independently
+    of each other, and only the members of a room vote on its batches.
+    """
+    def __init__(self, node, name, history):
+        self.node = node
+        self.name = name
+
+        # Our batches that are not committed yet, in index order
+        self.proposals = []
+        # Messages that we want to commit after the proposed batches, as
+        # lists of senders, messages and message ids
+        self.outbound_queue = BoundedQueue(
+            OUTBOUND_QUEUE_SIZE, OUTBOUND_QUEUE_POLICY, coalesce_batches,
+            lambda item: self.node.metrics.count("dropped_messages", len(item[1])))
+        # Our messages are identified by our nickname, incarnation and a
+        # sequence number, so a message committed twice is noticed
+        self.message_ids = itertools.count()
+        # Scheduled call for proposing rejected batches again
+        self.retry_timer = None
+
+        # Leader of the room in leader mode. The leader proposes the batches
+        # of all members, so that their proposals don't collide.
+        self.term = 0
+        self.leader = None
+        # The term and the candidate we voted for in it
+        self.voted_for = (0, None)
+        self.votes = 0
+        self.voters = 0
+        self.reset_election_timer()
+
+        # Batches that are being proposed for log currently, keyed by index.
+        # The values are the proposal id and the messages.
+        self.pending_other = {}
+        # Scheduled calls that release the pending batches, keyed by index
+        self.pending_timeouts = {}
+        self.proposal_ids = itertools.count()
+        # Committed batches that arrived before the batches preceding them
+        self.commits_ahead = {}
+        # Whether the commits we have missed are being fetched, and the peer
+        # to fetch them from again when commits are missed during the fetch
+        self.fetching = False
+        self.fetch_again = None
+
+        # Log of commited messages
+        self.history = history
+        self.next_message_index = self.history.next_index
+        # Latest snapshot of the history, sent to joining nodes
+        self.snapshot = self.history.load_snapshot()
+        # Ids of the latest committed messages, for not delivering the
+        # messages committed again
+        self.committed_ids = MessageIds()
+        for entry in self.history.read(self.history.next_index - DEDUP_CACHE_SIZE,
+                                       DEDUP_CACHE_SIZE):
+            if entry.get("id") is not None:
+                self.committed_ids.add(entry["id"])
+
+        # Guards the consensus state and the history, notified when a
+        # proposal is committed. It is taken by the server threads, the
+        # response callbacks, the scheduler and the proposer thread.
+        self.lock = Condition()
+        # Set when the history has been closed
+        self.closed = False
+
+    @property
+    def peer_hosts(self):
+        """
+        Addresses and nicknames of the live peers that have joined the room.
+        """
+        return self.view()[1]
+
+    def view(self):
+        return self.node.membership.view(self.name)
+
+    def start(self):
+        thread = Thread(target=self.run_proposer, name=f"proposer-{self.name}", daemon=True)
+        thread.start()
+
+    def stop(self):
+        try:
+            self.outbound_queue.put_nowait(None)
+        except queue.Full:
+            # The proposer isn't waiting for messages
+            pass
+        with self.lock:
+            if self.retry_timer:
+                self.retry_timer.cancel()
+            self.closed = True
+            self.lock.notify_all()
+            self.history.close()
+
+    def send(self, message):
+        message_id = f"{self.node.nickname}/{self.node.session}/{next(self.message_ids)}"
+        self.outbound_queue.put(([self.node.nickname], [message], [message_id]))
+
+    def catch_up(self, peer_host=None):
+        """
+        Fetches the messages we are missing. The peer's snapshot is used only
+        if the peer has compacted some of them.
+        """
+        self.get_history(peer_host)
+
+    def deliver(self, entry):
+        self.node.deliver({**entry, "room": self.name})
+
+    def deliver_new(self, entry):
+        """
+        Delivers a message appended to the history, unless the same message
+        was committed before. The duplicate keeps its index in the history,
+        so that the histories of the members stay the same.
+        """
+        message_id = entry.get("id")
+        if message_id is not None and not self.committed_ids.add(message_id):
+            logger.debug("Not delivering duplicate message %s at %d", message_id, entry["index"])
+            return
+        self.deliver(entry)
+
+    def handle_request(self, addr, message):
+        """
+        Handles one request of a peer to the room.
+
+        Returns:
+        dict: The response packet, or None for unknown requests.
+        """
+        if message.get("type") == "GET_HISTORY":
+            limit = min(message.get("limit") or HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+            with self.lock:
+                if self.closed:
+                    return None
+                return {"type": "HISTORY",
+                        "history": self.history.read(message.get("from_index", 0), limit),
+                        "next_index": self.history.next_index}
+        elif message.get("type") == "GET_SNAPSHOT":
+            with self.lock:
+                if self.closed:
+                    return None
+                if not self.snapshot:
+                    self.take_snapshot()
+                return {"type": "SNAPSHOT", **self.snapshot}
+        elif message.get("type") == "PROPOSE":
+            with self.lock:
+                pending = self.pending_other.get(message.get("index"))
+                if pending and pending[0] == message.get("proposal"):
+                    # A duplicate of a proposal we have already accepted
+                    value = "ack"
+                # Batches are accepted only right after the ones already
+                # accepted, so several of them can be pending at once.
+                elif (self.next_free_index() == message.get("index")
+                      and self.node.allow_senders(message.get("senders")
+                                                  or [message.get("sender")]
+                                                  * len(message.get("messages")))):
+                    self.set_pending_message(message.get("index"), message.get("proposal"),
+                                             message.get("messages"))
+                    value = "ack"
+                else:
+                    value = "reject"
+            return {
+                "type": "RESPONSE",
+                "value": value,
+                "index": message.get("index"),
+                "sender": self.node.nickname
+            }
+        elif message.get("type") == "ABORT":
+            with self.lock:
+                # The index may already be reserved for a newer proposal
+                pending = self.pending_other.get(message.get("index"))
+                if pending and pending[0] == message.get("proposal"):
+                    self.release_pending(message.get("index"))
+            return {"type": "ACK_ABORT", "sender": self.node.nickname}
+        elif message.get("type") == "COMMIT":
+            messages = message.get("messages")
+            with self.lock:
+                missed = self.apply_commit(message.get("index"), message.get("sender"), messages,
+                                           message.get("senders"), message.get("ids"))
+            if missed:
+                # Nobody is going to commit the missing batches to us
+                self.fetch_missing(self.node.peer_address(message.get("sender"), addr[0]))
+            logger.debug("Received by %s: %s", message.get('sender'), message)
+            formatted_message = (
+                f"Received {len(messages)} messages "
+                f"from {message['sender']}"
+            )
+            ack_commit = {"type": "ACK_COMMIT",
+                          "message": formatted_message,
+                          "sender": self.node.nickname}
+            logger.debug("%s sent ack %s", self.node.nickname, ack_commit)
+            return ack_commit
+        elif message.get("type") == "FORWARD":
+            with self.lock:
+                accepted = self.leader == self.node.nickname
+                term = self.term
+            messages = message.get("messages")
+            if accepted and not self.node.allow_senders(message.get("senders")):
+                accepted = False
+            if accepted:
+                try:
+                    self.outbound_queue.put((message.get("senders"), messages,
+                                             message.get("ids") or [None] * len(messages)),
+                                            block=False)
+                except queue.Full:
+                    # The member proposes the batch itself instead of
+                    # waiting for us
+                    self.node.metrics.count("forwards_refused")
+                    accepted = False
+            return {"type": "FORWARDED", "accepted": accepted, "term": term}
+        elif message.get("type") == "REQUEST_VOTE":
+            term = message.get("term", 0)
+            with self.lock:
+                if term > self.term:
+                    self.follow(term, None)
+                # One vote per term, and the leader must have every batch we
+                # have committed
+                voted_term, candidate = self.voted_for
+                granted = (term == self.term
+                           and (voted_term < term or candidate == message.get("candidate"))
+                           and message.get("next_index", 0) >= self.next_message_index)
+                if granted:
+                    self.voted_for = (term, message.get("candidate"))
+                    self.reset_election_timer()
+                return {"type": "VOTE", "term": self.term, "granted": granted}
+        elif message.get("type") == "LEADER":
+            term = message.get("term", 0)
+            with self.lock:
+                if term >= self.term:
+                    self.follow(term, message.get("leader"))
+                    self.reset_election_timer()
+                return {"type": "LEADER_ACK", "term": self.term}
+
+    def reset_election_timer(self):
+        self.election_deadline = self.node.clock() + random.uniform(*ELECTION_TIMEOUT)
+
+    def follow(self, term, leader):
+        """
+        Moves to a newer term or learns its leader. Must be called with the
+        lock held.
+        """
+        if leader != self.leader or term != self.term:
+            logger.info("Room %s term %d, leader %s", self.name, term, leader)
+        self.term = term
+        self.leader = leader
+
+    def tick(self):
+        """
+        Keeps a leader in leader mode. The leader sends its heartbeat, and
+        the other members start an election if it has been silent too long.
+        """
+        with self.lock:
+            if self.leader == self.node.nickname:
+                self.send_leader_heartbeat()
+            elif self.node.clock() > self.election_deadline:
+                self.start_election()
+
+    def start_election(self):
+        """
+        Must be called with the lock held.
+        """
+        self.follow(self.term + 1, None)
+        self.voted_for = (self.term, self.node.nickname)
+        self.reset_election_timer()
+        peer_hosts = self.peer_hosts
+        self.votes = 1
+        self.voters = len(peer_hosts) + 1
+        if self.votes > self.voters / 2:
+            self.become_leader()
+            return
+        futures = self.node.broadcast({"type": "REQUEST_VOTE", "room": self.name, "term": self.term,
+                                       "candidate": self.node.nickname,
+                                       "next_index": self.next_message_index}, peer_hosts)
+        for future, peer_host in futures.items():
+            future.add_done_callback(
+                lambda future, peer_host=peer_host, term=self.term:
+                self.count_election_vote(term, peer_host, future))
+
+    def count_election_vote(self, term, peer_host, future):
+        response = self.node.handle_response(peer_host, future)
+        with self.lock:
+            if response and response.get("term", 0) > self.term:
+                self.follow(response["term"], None)
+                return
+            if term != self.term or self.leader or not (response and response.get("granted")):
+                return
+            self.votes += 1
+            if self.votes > self.voters / 2:
+                self.become_leader()
+
+    def become_leader(self):
+        """
+        Must be called with the lock held.
+        """
+        self.follow(self.term, self.node.nickname)
+        self.send_leader_heartbeat()
+
+    def send_leader_heartbeat(self):
+        futures = self.node.broadcast({"type": "LEADER", "room": self.name, "term": self.term,
+                                       "leader": self.node.nickname}, self.peer_hosts)
+        for future, peer_host in futures.items():
+            future.add_done_callback(
+                lambda future, peer_host=peer_host: self.check_leader_ack(peer_host, future))
+
+    def check_leader_ack(self, peer_host, future):
+        response = self.node.handle_response(peer_host, future)
+        with self.lock:
+            # Step down if the others have moved to a newer term
+            if response and response.get("term", 0) > self.term:
+                self.follow(response["term"], None)
+
+    def forward(self, senders, messages, ids):
+        """
+        Passes a batch to the leader instead of proposing it ourselves.
+
+        Returns:
+        bool: True if the leader took the batch.
+        """
+        with self.lock:
+            leader = self.leader
+        if leader is None or leader == self.node.nickname:
+            return False
+        address = self.node.peer_address(leader, None)
+        if address is None:
+            return False
+        try:
+            response = self.node.transport.request(address, {"type": "FORWARD",
+                                                              "room": self.name,
+                                                              "senders": senders,
+                                                              "messages": messages,
+                                                              "ids": ids})
+        except Exception as exc:
+            logger.debug("Failed to forward to %s: %s", leader, exc)
+            return False
+        if response.get("accepted"):
+            self.node.metrics.count("forwarded", len(messages))
+            return True
+        return False
+
+    def run_proposer(self):
+        """
+        Proposes the queued messages in batches until the program exits.
+        At most PIPELINE_WINDOW batches are waiting to be committed.
+        """
+        while not self.node.stopped:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            senders, messages, ids = batch
+            # Without a reachable leader we propose the batch ourselves
+            if self.node.leader_mode and self.forward(senders, messages, ids):
+                continue
+            with self.lock:
+                while len(self.proposals) >= PIPELINE_WINDOW and not self.node.stopped:
+                    self.lock.wait()
+                self.add_proposal(senders, messages, ids)
+
+    def propose_queued(self):
+        """
+        Proposes the messages queued so far without waiting for more, for
+        nodes run without the proposer thread, like in the simulator.
+        """
+        while True:
+            with self.lock:
+                if len(self.proposals) >= PIPELINE_WINDOW:
+                    return
+            batch = self.next_batch(block=False)
+            if batch is None:
+                return
+            if self.node.leader_mode and self.forward(*batch):
+                continue
+            with self.lock:
+                self.add_proposal(*batch)
+
+    def add_proposal(self, senders, messages, ids):
+        """
+        Must be called with the lock held.
+        """
+        self.proposals.append(Proposal(messages, senders, ids, self.node.clock))
+        self.propose_waiting()
+
+    def next_batch(self, block=True):
+        """
+        Waits for the next queued message and collects the messages queued
+        right after it into the same batch.
+
+        Args:
+        block (bool): Whether to wait for the messages, or to take only the
+            ones already queued.
+
+        Returns:
+        tuple: The senders, the messages and the message ids to propose
+        together, None when the node is stopped or nothing is queued.
+        """
+        try:
+            first = self.outbound_queue.get(block)
+        except queue.Empty:
+            return None
+        if first is None:
+            return None
+        senders, batch, ids = list(first[0]), list(first[1]), list(first[2])
+        size = sum(len(message.encode()) for message in batch)
+        deadline = time.monotonic() + BATCH_DELAY
+        while len(batch) < MAX_BATCH_MESSAGES and size < MAX_BATCH_BYTES:
+            try:
+                item = self.outbound_queue.get(block, max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Stop after proposing this batch
+                try:
+                    self.outbound_queue.put_nowait(None)
+                except queue.Full:
+                    pass
+                break
+            senders.extend(item[0])
+            batch.extend(item[1])
+            ids.extend(item[2])
+            size += sum(len(message.encode()) for message in item[1])
+        return senders, batch, ids
+
+    def next_free_index(self):
+        """
+        Returns the first index after the batches committed or accepted so far.
+        """
+        index = self.next_message_index
+        while index in self.pending_other or index in self.commits_ahead:
+            pending = self.pending_other.get(index) or self.commits_ahead[index]
+            index += len(pending[1])
+        return index
+
+    def apply_commit(self, index, sender, messages, senders=None, ids=None):
+        """
+        Appends a committed batch to the history. Batches that arrive ahead of
+        the preceding batches wait until the gap has been filled.
+        Must be called with the lock held.
+
+        Args:
+        index (int): Index of the first message of the batch.
+        sender (str): Nickname of the proposer.
+        messages (list): The committed messages.
+        senders (list): Sender of each message, if not all are the proposer.
+        ids (list): Id of each message, if known.
+
+        Returns:
+        bool: True if some of the preceding batches are missing and not
+        pending.
+        """
+        self.release_pending(index)
+        if self.closed:
+            return False
+        if index < self.next_message_index:
+            # Also duplicates of the commits we have applied end up here
+            logger.debug("Ignoring commit of old index %d from %s", index, sender)
+            return False
+        if index not in self.commits_ahead:
+            self.node.charge_senders(senders or [sender] * len(messages))
+        self.commits_ahead[index] = (senders or [sender] * len(messages), messages,
+                                     ids or [None] * len(messages))
+        self.apply_commits_ahead()
+        return self.missing_commits()
+
+    def missing_commits(self):
+        """
+        Tells whether some batches before the committed ones are missing and
+        not pending. Must be called with the lock held.
+        """
+        # Pending batches fill only the start of the gap if we have missed
+        # commits after them
+        return bool(self.commits_ahead) and self.next_free_index() < max(self.commits_ahead)
+
+    def fetch_missing(self, peer_host):
+        """
+        Fetches the commits we have missed in the background, so that the
+        request that revealed the gap is answered right away. Only one fetch
+        runs at a time, and the commits missed during it are fetched after it.
+
+        Args:
+        peer_host (str): The history is requested from this peer.
+        """
+        with self.lock:
+            if self.fetching:
+                self.fetch_again = peer_host
+                return
+            self.fetching = True
+        try:
+            self.node.executor.submit(self.run_fetches, peer_host)
+        except RuntimeError:
+            # The node has been stopped
+            with self.lock:
+                self.fetching = False
+
+    def run_fetches(self, peer_host):
+        while True:
+            self.get_history(peer_host)
+            with self.lock:
+                peer_host, self.fetch_again = self.fetch_again, None
+                if peer_host is None or self.closed or not self.missing_commits():
+                    self.fetching = False
+                    return
+
+    def apply_commits_ahead(self):
+        for stale in [i for i in self.commits_ahead if i < self.next_message_index]:
+            del self.commits_ahead[stale]
+        # The whole batch is applied at once
+        while self.next_message_index in self.commits_ahead:
+            senders, messages, ids = self.commits_ahead.pop(self.next_message_index)
+            self.append_history(self.next_message_index, senders, messages, ids)
+            self.next_message_index += len(messages)
+
+    def append_history(self, index, senders, messages, ids):
+        """
+        Appends a committed batch to the history. The messages get
+        consecutive indices starting from the index of the batch.
+        """
+        for offset, (sender, content, message_id) in enumerate(zip(senders, messages, ids)):
+            self.history.append(index + offset, sender, content, message_id)
+            entry = {"index": index + offset, "sender": sender, "message": content}
+            if message_id is not None:
+                entry["id"] = message_id
+            self.deliver_new(entry)
+        self.history.sync()
+        self.maybe_snapshot()
+
+    def append_entries(self, entries):
+        """
+        Appends history entries received from a peer, skipping the ones we
+        already have. Must be called with the lock held.
+
+        Returns:
+        bool: False if the entries start after the end of our history.
+        """
+        if self.closed:
+            return True
+        continuous = True
+        for item in entries:
+            if item["index"] < self.history.next_index:
+                continue
+            if item["index"] > self.history.next_index:
+                continuous = False
+                break
+            self.history.append(item["index"], item["sender"], item["message"], item.get("id"))
+            self.deliver_new(item)
+        self.history.sync()
+        self.next_message_index = max(self.next_message_index, self.history.next_index)
+        self.apply_commits_ahead()
+        self.maybe_snapshot()
+        return continuous
+
+    def maybe_snapshot(self):
+        """
+        Takes a snapshot after every SNAPSHOT_INTERVAL messages.
+        """
+        last_index = self.snapshot["next_index"] if self.snapshot else 0
+        if self.history.next_index - last_index >= SNAPSHOT_INTERVAL:
+            self.take_snapshot()
 
-    def print_messages(self):
-        size = os.get_terminal_size()
-        sys.stdout.write(f"\033[1;1H")
-        start = len(self.content) - self.scroll - (size.lines - 2)
-        offset = -start if start < 0 else 0
-        for index, line in enumerate(self.content[max(0, start):][:size.lines - 2]):
-            sys.stdout.write(f"\033[{index + offset + 1};1H")
-            sys.stdout.write(line)
-        sys.stdout.flush()
+    def take_snapshot(self):
+        """
+        Saves the latest messages and the membership as the snapshot sent to
+        joining nodes, then drops the history over the retention limits.
+        Must be called with the lock held.
+        """
+        next_index = self.history.next_index
+        self.snapshot = {
+            "next_index": next_index,
+            "peers": [list(peer_host) for peer_host in self.peer_hosts],
+            "messages": self.history.read(next_index - SNAPSHOT_MESSAGES, SNAPSHOT_MESSAGES),
+            "time": time.time()
+        }
+        self.history.save_snapshot(self.snapshot)
+        self.history.compact(HISTORY_RETAIN_COUNT, HISTORY_RETAIN_BYTES, HISTORY_RETAIN_AGE)
+        logger.debug("Snapshot at index %d, history starts at %d",
+                     next_index, self.history.first_index)
+
+    def get_snapshot(self, peer_host):
+        """
+        Requests the latest snapshot from a peer. If it is ahead of our
+        history, the history continues from the snapshot and only the
+        messages after it need to be fetched.
 
-    def run(self):
-        if os.name == 'nt':
-            self.run_plain()
-        else:
-            self.run_fancy()
+        Args:
+        peer_host (str): The request is send to this peer.
 
-    def run_input_listener(self):
+        Returns:
+        bool: True if the history was moved forward.
+        """
+        if not self.peer_hosts:
+            return False
+        host = peer_host or list(self.peer_hosts)[0][0]
         try:
-            while not self.exited:
-                new_char = sys.stdin.read(1)
-                logger.info(f"handle read: {ord(new_char)}")
-                self.event_queue.put({"type": 'input', "char": new_char})
-        finally:
-            self.exited = True
+            snapshot = self.node.transport.request(host, {"type": "GET_SNAPSHOT",
+                                                           "room": self.name})
+        except Exception as exc:
+            logger.error("Failed to request snapshot: %s", exc)
+            return False
+
+        with self.lock:
+            if snapshot.get("next_index", 0) <= self.history.next_index:
+                return False
+            messages = snapshot.get("messages", [])
+            first_index = messages[0]["index"] if messages else snapshot["next_index"]
+            if first_index > self.history.next_index:
+                # The messages in between are not available anymore
+                self.history.reset(first_index)
+                self.next_message_index = first_index
+            self.append_entries(messages)
+            return True
 
-    def run_fancy(self):
-        try:
-            print("\033[?1049h")
-            tty_attrs = termios.tcgetattr(sys.stdin)
-            tty.setraw(sys.stdin)
-            self.print_messages()
-            self.print_footer()
+    def get_history(self, peer_host):
+        """
+        Requests the messages we don't have yet from a peer, one page at a
+        time. Appends them to history. If the peer has compacted the messages
+        that follow our history, the history continues from its snapshot.
 
-            thread = Thread(target=self.run_input_listener, name="input")
-            thread.start()
+        Args:
+        peer_host (str): The request is send to this peer.
 
-            while not self.exited:
-                logger.info(f"wait")
-                event = self.event_queue.get()
-                logger.info(f"handle event: {event}")
-
-                if event["type"] == "input":
-                    new_char = event["char"]
-                    if ord(new_char) == 3:
-                        raise KeyboardInterrupt()
-                    elif ord(new_char) == 4:
+        Raises:
+        Exception: If the connection fails.
+        """
+        if not self.peer_hosts:
+            return
+        else:
+            host = peer_host or list(self.peer_hosts)[0][0]
+            try:
+                while True:
+                    with self.lock:
+                        from_index = self.history.next_index
+                    response = self.node.transport.request(host, {"type": "GET_HISTORY",
+                                                                  "room": self.name,
+                                                                  "from_index": from_index,
+                                                                  "limit": HISTORY_PAGE_SIZE})
+                    page = response.get("history", [])
+                    with self.lock:
+                        continuous = self.append_entries(page)
+                        done = self.history.next_index >= response.get("next_index", 0)
+                    if not continuous or not page and not done:
+                        # The peer has compacted the messages we are missing
+                        logger.debug("History from %s starts after %d", host, from_index)
+                        if self.get_snapshot(host):
+                            continue
+                        break
+                    if done or not page or self.history.next_index == from_index:
                         break
-                    elif ord(new_char) == 27:
-                        code = sys.stdin.read(2)
-                        if code == "[D":
-                            self.cursor = max(0, self.cursor - 1)
-                        elif code == "[C":
-                            self.cursor = max(len(self.buffer), self.cursor + 1)
-                    elif ord(new_char) == 13:
-                        if self.buffer.strip() == "\\exit":
-                            break
-                        self.send_message(self.buffer)
-                        self.buffer = ""
-                        self.cursor = 0
-                    elif ord(new_char) == 127:
-                        self.buffer = self.buffer[0:self.cursor - 1] + self.buffer[self.cursor:]
-                        self.cursor = max(0, self.cursor - 1)
-                    else:
-                        self.buffer += new_char
-                        self.cursor += 1
-                elif event["type"] == "error":
-                    self.content.append("\033[1m\033[31m" + event["content"] + "\033[0m")
-                elif event["type"] == "info":
-                    self.content.append("\033[1m\033[90m" + event["content"] + "\033[0m")
-                elif event["type"] == "user_message":
-                    size = os.get_terminal_size()
-                    color = hash_func(event['sender']) % 7
-                    content = event['content']
-                    first = True
-                    while content:
-                        line = content[:size.columns]
-                        content = content[size.columns:]
-                        if first:
-                            self.content.append(f"\033[9{color}m{event['sender']}\033[0m: {event['content']}")
-                        else:
-                            self.content.append(f"{' ' * len(event['sender'])}  {event['content']}")
-                        first = False
-
-                # refresh screen content after every event
-                sys.stdout.write("\033[1;1H\033[0J")
-                self.print_messages()
-                self.print_footer()
 
-        except Exception as exc:
-            logger.exception(exc)
-            raise exc
-        finally:
-            self.exited = True
-            sys.stdout.write("\033[0m\033[?1049l")
-            sys.stdout.flush()
-            termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, tty_attrs)
-            os._exit(0)
+            except Exception as exc:
+                logger.error("Failed to request history: %s", exc)
 
-    def run_plain(self):
+    def set_pending_message(self, index, proposal_id, message, timeout=3):
         """
-        The fallback ui for windows
+        Sets incoming pending batch of messages.
+
+        Args:
+        index (int): Index of the first message of the batch.
+        proposal_id (str): Identifies the proposal of the batch.
+        message(list): The messages which are set as pending.
+        timeout (int): The timeout for the pending message.
         """
-        try:
-            thread = Thread(target=self.plain_events, name="events")
-            thread.start()
-            while True:
-                message = input()
-                if message.strip() == "\\exit":
-                    break
-                self.send_message(message)
-        except Exception as exc:
-            logger.exception(exc)
-            self.exited = True
-        finally:
-            os._exit(0)
+        self.release_pending(index)
+        self.pending_other[index] = (proposal_id, message)
+        self.pending_timeouts[index] = self.node.scheduler.schedule(timeout, self.expire_pending,
+                                                                    index)
 
-    def plain_events(self):
-        while not self.exited:
-            logger.info(f"wait")
-            event = self.event_queue.get()
-            logger.info(f"handle event: {event}")
+    def expire_pending(self, index):
+        with self.lock:
+            self.release_pending(index)
 
-            if event["type"] == "error":
-                print("\033[1m\033[31m" + event["content"] + "\033[0m")
-            elif event["type"] == "info":
-                print(event["content"])
-            elif event["type"] == "user_message":
-                size = os.get_terminal_size()
-                color = hash_func(event['sender']) % 7
-                content = event['content']
-                first = True
-                while content:
-                    line = content[:size.columns]
-                    content = content[size.columns:]
-                    if first:
-                        print(f"\033[9{color}m{event['sender']}\033[0m: {event['content']}")
-                    else:
-                        print(f"{' ' * len(event['sender'])}  {event['content']}")
-                    first = False
+    def release_pending(self, index):
+        """
+        Removes a pending batch and cancels its timeout. Must be called with
+        the lock held.
+        """
+        self.pending_other.pop(index, None)
+        timeout = self.pending_timeouts.pop(index, None)
+        if timeout:
+            timeout.cancel()
+
+    def propose_waiting(self):
+        """
+        Proposes our batches that are not proposed yet, each one right after
+        the batch before it. Must be called with the lock held.
+        """
+        if self.retry_timer:
+            return
+        index = self.next_message_index
+        # Votes that arrive during the loop can commit or abort proposals
+        for proposal in list(self.proposals):
+            if proposal.index is None:
+                if not proposal.drop_committed(self.committed_ids):
+                    self.proposals.remove(proposal)
+                    self.lock.notify_all()
+                    continue
+                if index in self.pending_other:
+                    # We have acked another batch at the index, and taking
+                    # the index for ours would vote for both
+                    self.retry_timer = self.node.scheduler.schedule(
+                        random.uniform(*RETRY_DELAY), self.retry)
+                    return
+                self.propose(proposal, index)
+                if self.retry_timer:
+                    return
+            index = proposal.index + len(proposal.messages)
+
+    def propose(self, proposal, index):
+        """
+        Sends the proposal of one batch to all peers. The votes are counted
+        as they arrive, without waiting for the round to finish.
+        """
+        proposal_id = f"{self.node.nickname}/{next(self.proposal_ids)}"
+        # We don't vote for other batches at the same index either
+        self.set_pending_message(index, proposal_id, proposal.messages)
+        # The majority is counted from the view the proposal was sent to
+        version, peer_hosts = self.view()
+        propose = {
+            "type": "PROPOSE",
+            "room": self.name,
+            "index": index,
+            "proposal": proposal_id,
+            "messages": proposal.messages,
+            "sender": self.node.nickname
+        }
+        if any(sender != self.node.nickname for sender in proposal.senders):
+            # For the rate limits of the senders
+            propose["senders"] = proposal.senders
+        futures = self.node.broadcast(propose, peer_hosts)
+        proposal.start_round(index, proposal_id, len(futures))
+        logger.debug("Proposed %s at %d to %d peers in membership version %d",
+                     proposal_id, index, len(futures), version)
+        self.node.metrics.count("proposals")
+        if proposal.decide():
+            self.advance()
+        for future, peer_host in futures.items():
+            future.add_done_callback(
+                lambda future, peer_host=peer_host, round=proposal.round:
+                self.count_vote(proposal, round, peer_host, future))
+
+    def count_vote(self, proposal, round, peer_host, future):
+        response = self.node.handle_response(peer_host, future)
+        value = response and response.get("value")
+        self.node.metrics.count(VOTE_COUNTERS.get(value, "missing_votes"))
+        with self.lock:
+            # Late votes of a decided round don't matter
+            if proposal.round != round or proposal.accepted is not None:
+                return
+            if proposal.add_vote(value):
+                self.node.metrics.observe("propose_seconds",
+                                          self.node.clock() - proposal.round_started)
+                self.advance()
+            elif proposal.acks + proposal.rejects == proposal.peer_count // 2 + 1:
+                # The votes are split with a competing batch, and the peers
+                # that could still decide the round may never answer
+                self.node.scheduler.schedule(VOTE_TIMEOUT, self.expire_round, proposal, round)
+
+    def expire_round(self, proposal, round):
+        with self.lock:
+            if proposal.round != round or proposal.accepted is not None:
+                return
+            proposal.accepted = False
+            self.advance()
+
+    def advance(self):
+        """
+        Commits our accepted batches in index order. If a batch was rejected,
+        it and all the batches after it are proposed again after a delay.
+        Must be called with the lock held.
+        """
+        while self.proposals and self.proposals[0].accepted:
+            self.commit(self.proposals.pop(0))
+        for position, proposal in enumerate(self.proposals):
+            if proposal.accepted is False:
+                self.node.metrics.count("rejected")
+                self.abort(self.proposals[position:])
+                break
+        self.lock.notify_all()
+
+    def commit(self, proposal):
+        self.node.metrics.count("committed", len(proposal.messages))
+        self.node.metrics.observe("commit_seconds", self.node.clock() - proposal.created)
+        self.node.metrics.observe("batch_messages", len(proposal.messages))
+        self.apply_commit(proposal.index, self.node.nickname, proposal.messages, proposal.senders,
+                          proposal.ids)
+        commit = {
+            "type": "COMMIT",
+            "room": self.name,
+            "index": proposal.index,
+            "messages": proposal.messages,
+            "ids": proposal.ids,
+            "sender": self.node.nickname
+        }
+        if any(sender != self.node.nickname for sender in proposal.senders):
+            commit["senders"] = proposal.senders
+        futures = self.node.broadcast(commit, self.peer_hosts)
+        for future, peer_host in futures.items():
+            future.add_done_callback(
+                lambda future, peer_host=peer_host: self.node.handle_response(peer_host, future))
+
+    def abort(self, proposals):
+        """
+        Releases the indices of the proposed batches and schedules proposing
+        them again. Must be called with the lock held.
+        """
+        for proposal in proposals:
+            if proposal.index is None:
+                continue
+            self.release_pending(proposal.index)
+            futures = self.node.broadcast({"type": "ABORT", "room": self.name,
+                                           "index": proposal.index, "proposal": proposal.id,
+                                           "sender": self.node.nickname}, self.peer_hosts)
+            for future, peer_host in futures.items():
+                future.add_done_callback(
+                    lambda future, peer_host=peer_host: self.node.handle_response(peer_host, future))
+            proposal.reset()
+        if not self.retry_timer:
+            self.retry_timer = self.node.scheduler.schedule(random.uniform(*RETRY_DELAY),
+                                                            self.retry)
+
+    def retry(self):
+        with self.lock:
+            self.node.metrics.count("retries")
+            self.retry_timer = None
+            self.propose_waiting()
 
 
 class Node:
     """
     The main code for communicating with other nodes
-    """
-    def __init__(self, hosts, nickname):
-        # Other nodes currently joined to chat
-        self.peer_hosts = set(hosts)
-        self.inactive_hosts = set()
 
+    Requests are handled by a thread per peer connection, responses by the
+    threads of our own connections and timeouts by the scheduler thread, so
+    the shared state is locked: the consensus state by the lock of each
+    room, the members by the lock of the membership, and the rooms,
+    subscribers, connections and metrics by locks of their own. No lock is
+    held while waiting for the response of a peer.
+    """
+    def __init__(self, hosts, nickname, history_dir=HISTORY_DIR, port=APPLICATION_PORT,
+                 bind_host="0.0.0.0", headless=False, leader_mode=False,
+                 metrics_port=METRICS_PORT, sender_rate_limit=SENDER_RATE_LIMIT,
+                 transport=None, scheduler=None, executor=None, clock=time.monotonic):
         # Our name that is visible to us and other nodes
         self.nickname = nickname
+        # Tells our messages apart from the ones we sent before a restart,
+        # whose ids may be remembered from the history on disk
+        self.session = uuid.uuid4().hex[:16]
+        # Returns the current time in seconds. The network, the timers and
+        # the clock are replaced by the simulator.
+        self.clock = clock
 
-        # Message that we are trying to send
-        self.pending_own = None
-        # Other messages that we want to commit after the current one
-        self.outbound_queue = queue.Queue()
+        # Other nodes currently joined to chat
+        self.membership = Membership(nickname, on_change=self.member_changed, clock=clock)
+        # Addresses to join the chat through
+        self.seeds = []
+        for host in hosts:
+            if isinstance(host, str):
+                self.seeds.append(host)
+            else:
+                self.membership.add(*host)
+        # Address that our server listens to
+        self.bind_host = bind_host
+        self.port = port
+        # Set once the server accepts connections, or has failed to start
+        self.server_ready = Event()
+        # The error that kept the server from starting, raised by start
+        self.server_error = None
+        self.server_stop = None
+        self.stopped = False
+        self.started = False
+        # Whether the batches are proposed by an elected leader of each room
+        self.leader_mode = leader_mode
+        # Counters of proposals, votes, retries and bytes, for benchmarks
+        # and the metrics
+        self.metrics = Metrics()
+        self.stats = self.metrics.counters
+        self.metrics.histogram("propose_seconds")
+        self.metrics.histogram("commit_seconds")
+        self.metrics.histogram("batch_messages", BATCH_BUCKETS)
+        # Port of the http endpoint of the metrics, None for no endpoint
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # Limits the messages accepted from each sender, None for no limit
+        self.rate_limiter = RateLimiter(sender_rate_limit, clock) if sender_rate_limit else None
+
+        # Logs of commited messages are kept on disk if a directory is given
+        self.history_dir = history_dir
+        # Rooms we have joined, keyed by name
+        self.rooms = {}
+        self.rooms_lock = Lock()
+        self.join_room(DEFAULT_ROOM)
+        if history_dir and os.path.isdir(self.room_directory(None)):
+            # Rejoin the rooms we were in before a restart
+            for name in sorted(os.listdir(self.room_directory(None))):
+                if ROOM_NAME.fullmatch(name):
+                    self.join_room(name)
+        # Room of the messages sent from the ui
+        self.ui_room = DEFAULT_ROOM
+
+        # Runs the timeouts, retries and heartbeats
+        self.scheduler = scheduler or Scheduler()
+        # Sends the requests to the other nodes
+        self.transport = transport or TcpTransport(self.metrics, self.scheduler)
+        # Runs the fetches of missed commits, which wait for the peers
+        self.executor = executor or ThreadPoolExecutor(max_workers=FETCH_WORKERS,
+                                                       thread_name_prefix="fetch")
+
+        # Functions called with every committed message. The list is
+        # replaced instead of modified, so it can be iterated without a lock.
+        self.subscribers = []
+        self.subscribers_lock = Lock()
+
+        # Queue for communicating with ui. A ui that can't keep up loses
+        # events instead of growing the queue.
+        self.event_queue = BoundedQueue(EVENT_QUEUE_SIZE, EVENT_QUEUE_POLICY, coalesce_events,
+                                        lambda event: self.metrics.count("dropped_events"))
+        # User interface component, None for nodes without a terminal
+        self.ui = None if headless else UserInterface(self.event_queue, self.send_ui_message,
+                                                      nickname)
+
+        self.metrics.gauge("event_queue", self.event_queue.qsize)
+        self.metrics.gauge("outbound_queue", self.room_gauge(lambda room: room.outbound_queue.qsize()))
+        self.metrics.gauge("proposals", self.room_gauge(lambda room: len(room.proposals)))
+        self.metrics.gauge("pending_batches", self.room_gauge(lambda room: len(room.pending_other)))
+        self.metrics.gauge("commits_ahead", self.room_gauge(lambda room: len(room.commits_ahead)))
+        self.metrics.gauge("log_index", self.room_gauge(lambda room: room.next_message_index))
+        self.metrics.gauge("term", self.room_gauge(lambda room: room.term))
+        self.metrics.gauge("members", lambda: len(self.peer_hosts))
+        self.metrics.gauge("membership_version", lambda: self.membership.version)
+
+    def room_gauge(self, function):
+        """
+        Returns a gauge function that reads a value of every room.
+        """
+        return lambda: {name: function(room) for name, room in list(self.rooms.items())}
 
-        # Current voting results for our own pending message
-        self.acks = 0
-        self.rejects = 0
+    def start(self, join=True, use_asyncio=False):
+        """
+        Starts the server and the proposer, and joins the chat through the
+        given hosts. The user interface is not started.
 
-        # Message that is being proposed for log currently
-        self.pending_other = None
+        Args:
+        join (bool): Whether to request the peers and the history.
+        use_asyncio (bool): Whether to serve the peers with asyncio.
 
-        # Log of commited messages
-        self.history = []
-        self.next_message_index = 0
+        Raises:
+        OSError: If the server can't listen to the port. The node is
+            stopped.
+        TimeoutError: If the server doesn't start in CONNECT_TIMEOUT seconds.
+        """
+        server = self.start_async_server if use_asyncio else self.start_server
+        self.server_thread = Thread(target=server, name="server", daemon=True)
+        self.server_thread.start()
+        if not self.server_ready.wait(CONNECT_TIMEOUT):
+            self.stop()
+            raise TimeoutError(f"Server didn't start in {CONNECT_TIMEOUT} seconds")
+        if self.server_error:
+            self.stop()
+            raise self.server_error
+        if self.metrics_port:
+            self.start_metrics_server()
+
+        if join and (self.seeds or self.peer_hosts):
+            self.request_peers()
+            self.send_address()
+            # Start from the latest snapshot and fetch only the messages after it
+            for room in list(self.rooms.values()):
+                room.catch_up()
+        with self.rooms_lock:
+            self.started = True
+            rooms = list(self.rooms.values())
+        for room in rooms:
+            room.start()
+        self.scheduler.schedule(HEARTBEAT_INTERVAL, self.heartbeat)
+        return self
+
+    def stop(self):
+        """
+        Stops the server and the proposer and closes the connections.
+        Messages that are not committed yet are dropped.
+        """
+        self.stopped = True
+        self.scheduler.stop()
+        if self.server_stop:
+            self.server_stop()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        self.transport.close()
+        self.executor.shutdown(wait=False)
+        for room in list(self.rooms.values()):
+            room.stop()
+
+    def send(self, message, room=DEFAULT_ROOM):
+        """
+        Queues a message to be sent to the chat. Waits while the queue of the
+        room is full, if its policy is to block.
+
+        Args:
+        message (str): Message to send.
+        room (str): Name of a room we have joined.
 
-        # Queue for communicating with ui
-        self.event_queue = queue.Queue()
-        # User interface component
-        self.ui = UserInterface(self.event_queue, self.send_ui_message, nickname)
+        Raises:
+        KeyError: If we haven't joined the room.
+        """
+        self.rooms[room].send(message)
 
     def send_ui_message(self, message):
         """
-        Function for printing messages in the user interface.
+        Function for printing messages in the user interface. The command
+        /join ROOM joins a room and sends the later messages to it.
 
         Args:
         message (str): Message to send.
         """
-        self.outbound_queue.put(message)
-        if not self.pending_own:
-            self.pending_own = self.outbound_queue.get(message)
-            self.send_message("PROPOSE")
+        command, _, name = message.partition(" ")
+        if command == "/join":
+            try:
+                self.join_room(name.strip())
+            except ValueError as exc:
+                self.post_event({"type": "error", "content": str(exc)})
+                return
+            self.ui_room = name.strip()
+            self.post_event({"type": "info", "content": f"Sending to room {self.ui_room}"})
+            return
+        self.send(message, self.ui_room)
+
+    def room_directory(self, name):
+        """
+        Returns the history directory of a room, or the directory of all the
+        other rooms than the default one if the name is None.
+        """
+        directory = os.path.join(self.history_dir, self.nickname)
+        if name == DEFAULT_ROOM:
+            return directory
+        return os.path.join(directory, "rooms", *([name] if name else []))
+
+    def join_room(self, name):
+        """
+        Joins a room, and fetches its history from the other members if the
+        node is already running.
+
+        Args:
+        name (str): Name of the room.
+
+        Returns:
+        Room: The joined room.
+
+        Raises:
+        ValueError: If the name is not a valid room name.
+        """
+        if not ROOM_NAME.fullmatch(name):
+            raise ValueError(f"Invalid room name {name!r}")
+        with self.rooms_lock:
+            room = self.rooms.get(name)
+            if room:
+                return room
+            if self.history_dir:
+                history = SegmentedLog(self.room_directory(name))
+            else:
+                history = MessageLog()
+            room = self.rooms[name] = Room(self, name, history)
+            started = self.started
+        self.membership.join_room(name)
+        if started:
+            room.catch_up()
+            room.start()
+        return room
+
+    def subscribe(self, callback):
+        """
+        Calls callback with every committed message in index order. The
+        callback is called with the lock held, so it must not block.
+
+        Args:
+        callback (function): Takes the history entry of the message.
+        """
+        with self.subscribers_lock:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self.subscribers_lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers
+                                if subscriber is not callback]
+
+    async def messages(self):
+        """
+        Iterates the messages committed after the call.
+
+        Yields:
+        dict: The history entry of the message.
+        """
+        loop = asyncio.get_running_loop()
+        entries = asyncio.Queue()
+
+        def callback(entry):
+            loop.call_soon_threadsafe(entries.put_nowait, entry)
+
+        self.subscribe(callback)
+        try:
+            while True:
+                yield await entries.get()
+        finally:
+            self.unsubscribe(callback)
+
+    @property
+    def peer_hosts(self):
+        """
+        Addresses and nicknames of the peers that are not known to be dead.
+        """
+        return self.membership.peers()
+
+    def member_changed(self, nickname, previous, status):
+        if status == DEAD:
+            self.post_event({"type": "info", "content": f"{nickname} has left."})
+        elif previous == DEAD:
+            self.post_event({"type": "info", "content": f"{nickname} is back."})
+
+    def heartbeat(self):
+        """
+        Sends a heartbeat with our member list to every member, every
+        HEARTBEAT_INTERVAL until the node is stopped. A member gets a new
+        heartbeat only after answering the previous one.
+        """
+        if self.stopped:
+            return
+        self.scheduler.schedule(HEARTBEAT_INTERVAL, self.heartbeat)
+        ping = {"type": "PING", "nickname": self.nickname, "port": self.port,
+                "incarnation": self.membership.incarnation,
+                "rooms": sorted(self.membership.rooms),
+                "members": self.membership.gossip()}
+        for peer_host in self.membership.check():
+            try:
+                future = self.transport.submit(peer_host[0], ping)
+            except RuntimeError:
+                # The transport was closed by stop
+                return
+            future.add_done_callback(
+                lambda future, peer_host=peer_host: self.handle_heartbeat(peer_host, future))
+        if self.leader_mode:
+            for room in list(self.rooms.values()):
+                room.tick()
+
+    def handle_heartbeat(self, peer_host, future):
+        try:
+            response = future.result()
+        except Exception as exc:
+            # Not the builtin TimeoutError before Python 3.11
+            if isinstance(exc, FutureTimeoutError):
+                self.transport.reset(peer_host[0])
+            self.membership.failed(peer_host[1], dead=self.is_refused(exc))
+            return
+        self.membership.refresh(peer_host[1], response.get("incarnation", 0),
+                                response.get("rooms"), heartbeat=True)
+        self.membership.merge(response.get("members"))
+
+    def allow_senders(self, senders):
+        """
+        Checks the rate limit of the senders of a batch proposed or forwarded
+        to us.
+
+        Returns:
+        bool: False if the batch should be refused.
+        """
+        if self.rate_limiter is None or self.rate_limiter.allow(senders):
+            return True
+        self.metrics.count("rate_limited", len(senders))
+        return False
+
+    def charge_senders(self, senders):
+        """
+        Charges the rate limit of the senders of a committed batch.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.charge(senders)
+
+    def post_event(self, event):
+        """
+        Passes an event to the user interface, if there is one.
+        """
+        if self.ui:
+            self.event_queue.put(event)
+
+    def deliver(self, entry):
+        """
+        Shows a committed message and passes it to the subscribers.
+        """
+        content = entry["message"]
+        if entry["room"] != DEFAULT_ROOM:
+            content = f"[{entry['room']}] {content}"
+        self.post_event({"type": "user_message",
+                         "sender": entry["sender"],
+                         "content": content})
+        for callback in self.subscribers:
+            try:
+                callback(entry)
+            except Exception:
+                logger.exception("Message subscriber failed")
 
     def start_server(self):
         """
@@ -258,66 +3336,181 @@ class Node:
         try:
             with socket(AF_INET, SOCK_STREAM) as s:
                 s.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-                s.bind(("0.0.0.0", APPLICATION_PORT))
+                s.bind((self.bind_host, self.port))
                 s.listen()
+                self.server_stop = lambda: close_listener(s)
+                self.server_ready.set()
                 while True:
                     conn, addr = s.accept()
-                    with conn:
-                        data = conn.recv(1024)
-                        message = json.loads(data)
-                        self.handle_request(conn, addr, message)
-        except Exception:
-            logger.exception("Server thread")
-            self.event_queue.put({"type": "error", "content": "Server thread error"})
+                    # Peers keep their connection open, so each one is
+                    # served by its own thread.
+                    thread = Thread(target=self.serve_connection, args=[conn, addr],
+                                    name=f"peer-{addr[0]}", daemon=True)
+                    thread.start()
+        except Exception as exc:
+            self.server_failed(exc)
+
+    def server_failed(self, exc):
+        """
+        Passes an error that stopped the server to start if the server
+        never started, or reports it.
+        """
+        if self.stopped:
+            return
+        if not self.server_ready.is_set():
+            self.server_error = exc
+            self.server_ready.set()
+            return
+        logger.exception("Server thread")
+        self.post_event({"type": "error", "content": "Server thread error"})
+
+    def start_metrics_server(self):
+        """
+        Serves the metrics in the Prometheus text format over http.
+        """
+        try:
+            self.metrics_server = ThreadingHTTPServer((self.bind_host, self.metrics_port),
+                                                      MetricsHandler)
+        except OSError:
+            logger.exception("Metrics server")
+            self.post_event({"type": "error", "content": "Metrics server error"})
+            return
+        self.metrics_server.daemon_threads = True
+        self.metrics_server.metrics = self.metrics
+        Thread(target=self.metrics_server.serve_forever, name="metrics", daemon=True).start()
+
+    def serve_connection(self, conn, addr):
+        """
+        Handles requests from one peer until it closes the connection.
+        """
+        encoding = ENCODING_JSON
+        with conn:
+            try:
+                for message in read_packets(conn, self.metrics):
+                    if self.stopped:
+                        # Peers must notice that we are gone
+                        break
+                    if message.get("type") == "HELLO":
+                        # Negotiate the encoding of all later responses
+                        name = choose_encoding(message.get("encodings"))
+                        send_packet(conn, {"type": "HELLO", "encoding": name,
+                                           "id": message.get("id")})
+                        encoding = ENCODING_NAMES[name]
+                        continue
+                    response = self.handle_request(addr, message)
+                    if response is None:
+                        response = {"type": "ERROR"}
+                    self.metrics.count("bytes_sent", send_packet(
+                        conn, {**response, "id": message.get("id")}, encoding))
+            except (OSError, ValueError) as exc:
+                logger.debug("Connection from %s closed: %s", addr[0], exc)
+
+    def start_async_server(self):
+        """
+        Starts the asyncio server. Serves every peer connection as a task in
+        a single thread instead of a thread per connection.
+        """
+        try:
+            asyncio.run(self.serve_async())
+        except Exception as exc:
+            self.server_failed(exc)
+
+    async def serve_async(self):
+        server = await asyncio.start_server(self.serve_connection_async, self.bind_host,
+                                            self.port, reuse_address=True)
+        loop = asyncio.get_running_loop()
+        self.server_stop = lambda: loop.call_soon_threadsafe(server.close)
+        # Not the default executor of the loop, which other code may share
+        self.request_executor = ThreadPoolExecutor(max_workers=ROOM_REQUEST_WORKERS,
+                                                   thread_name_prefix="requests")
+        self.server_ready.set()
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                # The server was closed by stop
+                pass
+            finally:
+                self.request_executor.shutdown(wait=False)
+
+    async def serve_connection_async(self, reader, writer):
+        """
+        Handles requests from one peer until it closes the connection.
+        """
+        addr = writer.get_extra_info("peername")
+        encoding = ENCODING_JSON
+        loop = asyncio.get_running_loop()
+        try:
+            while (message := await read_packet_async(reader, self.metrics)) is not None:
+                if self.stopped:
+                    break
+                if message.get("type") == "HELLO":
+                    # Negotiate the encoding of all later responses
+                    name = choose_encoding(message.get("encodings"))
+                    await send_packet_async(writer, {"type": "HELLO", "encoding": name,
+                                                     "id": message.get("id")})
+                    encoding = ENCODING_NAMES[name]
+                    continue
+                if message.get("type") in ROOM_REQUESTS:
+                    # The room lock can be held across a write of the
+                    # history to disk, which must not block the other
+                    # connections
+                    response = await loop.run_in_executor(self.request_executor,
+                                                          self.handle_request, addr, message)
+                else:
+                    response = self.handle_request(addr, message)
+                if response is None:
+                    response = {"type": "ERROR"}
+                self.metrics.count("bytes_sent", await send_packet_async(
+                    writer, {**response, "id": message.get("id")}, encoding))
+        except (OSError, ValueError) as exc:
+            logger.debug("Connection from %s closed: %s", addr[0], exc)
+        finally:
+            writer.close()
+
+    def handle_request(self, addr, message):
+        """
+        Handles one request from a peer.
 
-    def handle_request(self, conn, addr, message):
+        Returns:
+        dict: The response packet, or None for unknown requests.
+        """
         if message.get("type") == "GET_NODES":
-            send_packet(conn, {"nodes": list(self.peer_hosts)})
-            self.peer_hosts = {i for i in self.peer_hosts if i[0] != addr[0]}
-            self.peer_hosts.add((addr[0], message.get("nickname")))
-            self.event_queue.put({"type": "info",
-                                  "content": f"Server connected to {self.peer_hosts}"})
+            response = {"nodes": list(self.peer_hosts), "members": self.membership.gossip()}
+            address = format_address(addr[0], message.get("port", APPLICATION_PORT))
+            self.membership.add(address, message.get("nickname"), message.get("incarnation", 0),
+                                message.get("rooms"))
+            self.post_event({"type": "info",
+                             "content": f"Server connected to {self.peer_hosts}"})
+            return response
         elif message.get("type") == "NEW_NODE":
-            self.peer_hosts.add((addr[0], message.get("nickname")))
-            self.event_queue.put({"type": "info", "content": f"{message.get('nickname')} joined."})
-            send_packet(conn, {"type": "SYSTEM_INDEX", "index": self.next_message_index})
-        elif message.get("type") == "GET_HISTORY":
-            send_packet(conn, {"type": "HISTORY",
-                                "history": self.history})
-        elif message.get("type") == "PROPOSE":
-            if not self.pending_other and self.next_message_index == message.get("index"):
-                self.pending_other = self.set_pending_message(message.get("message"))
-                value = "ack"
-            else:
-                value = "reject"
-            send_packet(conn, {
-                "type": "RESPONSE",
-                "value": value,
-                "index": message.get("index"),
-                "sender": self.nickname
-            })
-        elif message.get("type") == "COMMIT":
-            if message.get("index") > self.next_message_index:
-                self.get_history(addr[0])
-            self.history.append({"index": message.get("index"),
-                                 "sender": message.get("sender"),
-                                 "message": message.get("message")})
-            if self.nickname != message.get('sender'):
-                self.event_queue.put({"type": "user_message",
-                                      "sender": message.get('sender'),
-                                      "content": message.get('message')})
-            logger.debug("Received by %s: %s", message.get('sender'), str(message))
-            formatted_message = (
-                f"Received {message['message']} "
-                f"from {message['sender']}"
-            )
-            ack_commit = {"type": "ACK_COMMIT",
-                          "message": formatted_message,
-                          "sender": self.nickname}
-            send_packet(conn, ack_commit)
-            self.pending_other = None
-            self.next_message_index = message.get('index') + 1
-            logger.debug("%s sent ack %s", self.nickname, ack_commit)
+            address = format_address(addr[0], message.get("port", APPLICATION_PORT))
+            self.membership.add(address, message.get("nickname"), message.get("incarnation", 0),
+                                message.get("rooms"))
+            self.post_event({"type": "info", "content": f"{message.get('nickname')} joined."})
+            return {"type": "SYSTEM_INDEX",
+                    "index": self.rooms[DEFAULT_ROOM].next_message_index}
+        elif message.get("type") == "PING":
+            # Heartbeats of unknown nodes, like the startup server, are
+            # answered but don't make them members
+            self.membership.refresh(message.get("nickname"), message.get("incarnation", 0),
+                                    message.get("rooms"))
+            self.membership.merge(message.get("members"))
+            return {"type": "PONG", "nickname": self.nickname,
+                    "incarnation": self.membership.incarnation,
+                    "rooms": sorted(self.membership.rooms),
+                    "members": self.membership.gossip()}
+        elif message.get("type") == "STATS":
+            return {"type": "STATS", **self.metrics.snapshot()}
+        elif message.get("type") in ROOM_REQUESTS:
+            room = self.rooms.get(message.get("room", DEFAULT_ROOM))
+            if room:
+                return room.handle_request(addr, message)
+            logger.debug("%s for room %s we haven't joined", message.get("type"),
+                         message.get("room"))
+            if message.get("type") == "PROPOSE":
+                return {"type": "RESPONSE", "value": "reject", "index": message.get("index"),
+                        "sender": self.nickname}
         else:
             logger.debug("Unknown %s type", message.get("type"))
 
@@ -328,224 +3521,196 @@ class Node:
         Raises:
         Exception: If the connection fails.
         """
-        local_address = gethostbyname(gethostname())
+        seed = self.seeds[0] if self.seeds else list(self.peer_hosts)[0][0]
         try:
-            response = send_packet_to_peer(list(self.peer_hosts)[0], {"type": "GET_NODES", "nickname": self.nickname})
+            response = self.transport.request(seed, {"type": "GET_NODES", "nickname": self.nickname,
+                                                     "port": self.port,
+                                                     "incarnation": self.membership.incarnation,
+                                                     "rooms": sorted(self.membership.rooms)})
 
-            self.peer_hosts.clear()
-            converted_nodes_list = [tuple(inner_list) for inner_list in response.get("nodes", [])]
-            self.peer_hosts.update(converted_nodes_list)
-            self.peer_hosts = {i for i in self.peer_hosts if i[0] != local_address}
+            if "members" in response:
+                self.membership.merge(response["members"])
+            else:
+                for address, nickname in response.get("nodes", []):
+                    self.membership.add(address, nickname)
 
             connected_to = []
             for i in self.peer_hosts:
                 connected_to.append(i[1])
-            print(f"Connected to {connected_to}")
+            logger.info("Connected to %s", connected_to)
+            if self.ui:
+                print(f"Connected to {connected_to}")
 
         except Exception:
             logger.exception("Failed to request peers")
-            self.event_queue.put({"type": "error", "content": "Failure on peer request"})
+            self.post_event({"type": "error", "content": "Failure on peer request"})
 
 
+    def peer_address(self, nickname, host):
+        """
+        Returns the address of the peer with the nickname, or the host if
+        the peer is not known.
+        """
+        for address, peer_nickname in self.peer_hosts:
+            if peer_nickname == nickname:
+                return address
+        return host
+
     def send_address(self):
         """
-        Sends address to all peers and receives indexes. Sets index.
+        Sends address to all peers and receives indexes. The index itself is
+        advanced by get_history as the missing messages are fetched.
 
         Raises:
-        JSONDecodeError: If the response data is invalid.
         Exception: If the connection fails.
         """
         next_message_indices = []
         try:
             for peer_host in self.peer_hosts:
                 try:
-                    response = send_packet_to_peer(peer_host[0], {"type": "NEW_NODE", "nickname": self.nickname})
+                    response = self.transport.request(peer_host[0], {"type": "NEW_NODE", "nickname": self.nickname, "port": self.port,
+                                                                     "incarnation": self.membership.incarnation,
+                                                                     "rooms": sorted(self.membership.rooms)})
                     next_message_indices.append(response.get("index"))
                 except Exception as exc:
                     self.handle_exception(peer_host, exc)
 
-            self.next_message_index = max(next_message_indices) if next_message_indices else 0
-            self.update_peer_hosts()
+            if next_message_indices:
+                logger.debug("Peers are at index %d, we are at %d",
+                             max(next_message_indices),
+                             self.rooms[DEFAULT_ROOM].next_message_index)
 
         except Exception:
             logger.exception("Failed to send address to peers")
-            self.event_queue.put({"type": "error",
-                                  "content": "Failure to send address to other participants"})
+            self.post_event({"type": "error",
+                             "content": "Failure to send address to other participants"})
 
-    def get_history(self, peer_host):
+    def broadcast(self, data, peer_hosts=None):
         """
-        Requests message history from a peer. Sets history.
+        Sends a request to every peer in parallel. Dead peers are skipped.
 
         Args:
-        peer_host (str): The request is send to this peer.
-
-        Raises:
-        Exception: If the connection fails.
-        """
-        if not self.peer_hosts:
-            return
-        else:
-            if not peer_host:
-                host = list(self.peer_hosts)[0]
-            try:
-                response = send_packet_to_peer(host[0], {"type": "GET_HISTORY"})
-                old_history = self.history
-                try:
-                    last_message_index = old_history[-1]["index"]
-                except IndexError:
-                    last_message_index = -1
-                self.history = response.get("history")
-                new_items = [item for item in self.history if item["index"] > last_message_index]
-
-                for message in new_items:
-                    self.event_queue.put({"type": "user_message",
-                                          "sender": message.get('sender'),
-                                          "content": message.get('message')})
-
-            except Exception as exc:
-                logger.error("Failed to request history: %s", exc)
+        data (dict): The request packet.
+        peer_hosts (set): The peers to send to, all live peers by default.
 
-    def set_pending_message(self, message, timeout=3):
+        Returns:
+        dict: Futures resolving to the responses, keyed by peer host.
         """
-        Sets incoming pending message.
-
-        Args:
-        message(str): The message which is set as pending.
-        timeout (int): The timeout for the pending message.
-        """
-        self.pending_other = message
-
-        def clear_pending_message():
-            self.pending_other = None
-
-        timer = Timer(timeout, clear_pending_message)
-        timer.start()
+        if peer_hosts is None:
+            peer_hosts = self.peer_hosts
+        try:
+            return {self.transport.submit(peer_host[0], data): peer_host
+                    for peer_host in peer_hosts}
+        except RuntimeError:
+            # The transport was closed by stop
+            return {}
 
-    def send_message(self, type):
+    def handle_response(self, peer_host, future):
         """
-        Issues a message. Receives acknowledgements, rejects and ack_commits.
+        Records the result of one request sent to a peer.
 
         Args:
-        type (str): Message type.
+        peer_host: The peer host the request was sent to.
+        future (Future): The finished request.
 
-        Raises:
-        Exception: If the connection fails.
+        Returns:
+        dict: The response, or None if the request failed.
         """
         try:
-            for peer_host in self.peer_hosts:
-                try:
-                    response = send_packet_to_peer(peer_host[0], {
-                        "type": type,
-                        "index": self.next_message_index,
-                        "message": self.pending_own,
-                        "sender": self.nickname
-                    })
-
-                    if response.get("type") == "RESPONSE":
-                        if response.get("value") == "ack":
-                            self.acks += 1
-                        elif response.get("value") == "reject":
-                            self.rejects += 1
-
-                    if response.get("type") == "ACK_COMMIT":
-                        self.event_queue.put({"type": "ack",
-                                              "message": response.get('message'),
-                                              "sender": response.get('sender')})
-
-                    logger.debug("Sent by %s: %s", self.nickname, str(response))
-                except Exception as exc:
-                    self.handle_exception(peer_host, exc)
-
-            self.update_peer_hosts()
+            response = future.result()
+        except Exception as exc:
+            self.handle_exception(peer_host, exc)
+            return None
 
-            if type == "PROPOSE":
-                self.handle_responses()
-                self.acks = 0
-                self.rejects = 0
+        if response.get("type") == "ACK_COMMIT":
+            self.post_event({"type": "ack",
+                             "message": response.get('message'),
+                             "sender": response.get('sender')})
 
-        except Exception:
-            logger.exception("Failed to propose message to peers")
-            self.event_queue.put({"type": "error",
-                                  "content": "Failed to propose message to peers"})
-
-    def handle_responses(self):
-        """
-        Handles acknowledges and rejects. Issues a commit message.
-        Issues a new propose message.
-        """
-        majority_agreement = self.acks > len(self.peer_hosts) / 2
-        if majority_agreement:
-            self.send_message("COMMIT")
-            self.event_queue.put({"type": "user_message",
-                                  "sender": self.nickname,
-                                  "content": self.pending_own})
-            self.history.append({"index": self.next_message_index,
-                                 "sender": self.nickname,
-                                 "message": self.pending_own})
-            self.next_message_index += 1
-            self.pending_own = None
-        else:
-            # Retry
-            delay = random.uniform(0.1, 0.3)
-            time.sleep(delay)
-            self.send_message("PROPOSE")
+        logger.debug("Sent by %s: %s", self.nickname, response)
+        return response
 
     def handle_exception(self, peer_host, exc):
         """
-        Handles connection refused errors.
+        Suspects a peer that failed a request. A peer that refuses the
+        connection has left, so it is declared dead right away.
 
         Args:
         peer_host: The peer host which an exception has occurred with.
         exc: The exception raised.
         """
-        if "Connection refused" in str(exc):
-            self.event_queue.put({"type": "info",
-                                  "content": f"{peer_host[1]} has left."})
-            logger.debug(f"Removing {peer_host} from set of peer hosts due to connection error.")
-            self.inactive_hosts.add(peer_host)
-
+        logger.debug("Request to %s failed: %s", peer_host, exc)
+        self.membership.failed(peer_host[1], dead=self.is_refused(exc))
 
-    def update_peer_hosts(self):
-        """
-        Helper method for updating the set of peer hosts, if inactive hosts are found.
-        """
-        if len(self.inactive_hosts) > 0:
-            logger.debug(f'Updating peer hosts. Inactive hosts :{self.inactive_hosts}; Active hosts: {self.peer_hosts}')
-            self.peer_hosts = self.peer_hosts - self.inactive_hosts
-            self.inactive_hosts.clear()
-            logger.debug(f'Inactive hosts removed from list of peer hosts. Current peer hosts: {self.peer_hosts}')
+    @staticmethod
+    def is_refused(exc):
+        return isinstance(exc, ConnectionRefusedError) or "Connection refused" in str(exc)
 
 # Only run this code if the file was executed from command line
 def main(args):
     if '--help' in args:
         print("Start the startup server:")
-        print(f"Usage: {args[0]} startup")
+        print(f"Usage: {args[0]} [OPTIONS] startup")
         print("Start the application:")
-        print(f"Usage: {args[0]} [STARTUP SERVER NAME]")
+        print(f"Usage: {args[0]} [OPTIONS] [STARTUP SERVER NAME]")
+        print("Options:")
+        print("  --asyncio          serve all peer connections with one thread")
+        print("  --leader           propose through an elected leader, all nodes must use it")
+        print("  --headless         run without the terminal ui, send each line of the")
+        print("                     standard input and print committed messages as json")
+        print("  --nickname=NAME    nickname to use instead of asking for it")
+        print(f"  --port=PORT        port to listen to, {APPLICATION_PORT} by default")
+        print("  --bind=HOST        address to listen to, all addresses by default")
         exit(-1)
 
-    if len(args) > 1 and args[1] == "startup":
+    options = {}
+    positional = []
+    for arg in args[1:]:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value
+        else:
+            positional.append(arg)
+    use_asyncio = 'asyncio' in options
+    leader_mode = 'leader' in options
+    port = int(options.get('port') or APPLICATION_PORT)
+    bind_host = options.get('bind') or "0.0.0.0"
+
+    if positional[:1] == ["startup"]:
         logger.info('Starting startup server')
         peer_hosts =  []
-        node = Node(peer_hosts, "startup_server")
+        # The startup server isn't a member of the rooms, so it never leads
+        node = Node(peer_hosts, "startup_server", port=port, bind_host=bind_host, headless=True)
+        node.start(join=False, use_asyncio=use_asyncio)
+        node.server_thread.join()
+    elif 'headless' in options:
+        logger.info('Starting headless peer node')
+        peer_hosts = positional or ["startup_server"]
+        nickname = options.get('nickname') or gethostname()
+        node = Node(peer_hosts, nickname, port=port, bind_host=bind_host, headless=True,
+                    leader_mode=leader_mode)
+        node.subscribe(lambda entry: print(json.dumps(entry), flush=True))
+        node.start(use_asyncio=use_asyncio)
+        for line in sys.stdin:
+            # Lines starting with /join switch the room like in the ui
+            node.send_ui_message(line.rstrip("\n"))
+        # Keep serving the peers after the input has ended
+        node.server_thread.join()
     else:
         logger.info('Starting peer node')
-        peer_hosts = args[1:] if len(args) > 1 else ["startup_server"]
-        nickname = input("Set nickname: ")
-        node = Node(peer_hosts, nickname)
-
-        node.request_peers()
-        node.send_address()
-        node.get_history(None)
+        peer_hosts = positional or ["startup_server"]
+        nickname = options.get('nickname') or input("Set nickname: ")
+        node = Node(peer_hosts, nickname, port=port, bind_host=bind_host,
+                    leader_mode=leader_mode)
+        node.start(use_asyncio=use_asyncio)
 
         # We are creating separate threads for server and client
         # so that they can run at same time. The sockets api is blocking.
+        if os.name != 'nt':
+            node.ui.watch_terminal_size()
         thread = Thread(target=node.ui.run, args=[], name="ui")
         thread.start()
 
-    thread = Thread(target=node.start_server, args=[], name="server")
-    thread.start()
-
 # Only run this code if the file was executed from command line
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,520 @@
+#!/bin/python3
+"""
+Deterministic simulation of a chat cluster in one process. The nodes run the
+real membership and consensus code, but their requests go through a simulated
+network with configurable latency, loss and partitions, and their timers run
+on a simulated clock. Reports the commit throughput and the time the nodes
+take to converge on the same history as the cluster grows.
+
+Runs with the same seed give the same results when PYTHONHASHSEED is fixed
+too, because the nodes iterate their member sets in hash order.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import random
+import sys
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from main import (
+    BATCH_DELAY, DEFAULT_ROOM, ENCODING_JSON, HEARTBEAT_INTERVAL, REQUEST_TIMEOUT, Node,
+    decode_packet, encode_packet
+)
+
+# Seconds before tcp sends a lost packet again, its minimum retransmission
+# timeout
+RETRANSMIT_DELAY = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedCall:
+    """
+    A call waiting in the simulation, cancelled like a ScheduledCall.
+    """
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Simulation:
+    """
+    Event loop of the simulated time. Events run one at a time in the order
+    of their time, and events of the same time in the order they were added.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+        # Number of events that raised an exception
+        self.errors = 0
+
+    def clock(self):
+        return self.now
+
+    def schedule(self, delay, function, *args):
+        call = SimulatedCall()
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), call, function, args))
+        return call
+
+    def run(self, until):
+        """
+        Runs the events up to the given time.
+        """
+        while self.events and self.events[0][0] <= until:
+            self.now, _, call, function, args = heapq.heappop(self.events)
+            if call.cancelled:
+                continue
+            try:
+                function(*args)
+            except Exception:
+                self.errors += 1
+                logger.exception("Simulated event failed")
+        self.now = max(self.now, until)
+
+
+class NodeScheduler:
+    """
+    Scheduler of one node. Stopping it drops only the timers of the node.
+    """
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.stopped = False
+
+    def schedule(self, delay, function, *args):
+        return self.simulation.schedule(delay, self.run, function, args)
+
+    def run(self, function, args):
+        if not self.stopped:
+            function(*args)
+
+    def stop(self):
+        self.stopped = True
+
+    def submit(self, function, *args):
+        """
+        Runs a background task of the node as a timer, so that the tasks run
+        in the order of the simulation as well.
+        """
+        return self.schedule(0, function, *args)
+
+    def shutdown(self, wait=True):
+        self.stop()
+
+
+class Network:
+    """
+    Delivers the requests between the simulated nodes. The nodes talk over
+    tcp, so the packets of a link arrive in order and a lost packet is sent
+    again after RETRANSMIT_DELAY instead of failing the request. Requests
+    fail only across a partition or to a stopped node. Every direction of
+    every link has its own random generator, so the delays of a link don't
+    depend on the order the nodes send in.
+    """
+    def __init__(self, simulation, seed, latency=(0.001, 0.005), loss=0.0):
+        self.simulation = simulation
+        self.seed = seed
+        # Range of one-way delays in seconds
+        self.latency = latency
+        # Probability that a packet is lost and has to be sent again
+        self.loss = loss
+        # Nodes keyed by address
+        self.nodes = {}
+        # Group number of each address while the network is partitioned
+        self.groups = None
+        self.links = {}
+        # Arrival time of the latest packet of each link
+        self.arrivals = {}
+        # The latest packet and its encoding, as a broadcast sends the same
+        # packet to every peer
+        self.encoded = (None, None)
+        self.requests = 0
+        self.retransmits = 0
+        self.bytes = 0
+
+    def link(self, source, target):
+        generator = self.links.get((source, target))
+        if generator is None:
+            generator = random.Random(f"{self.seed}/{source}/{target}")
+            self.links[(source, target)] = generator
+        return generator
+
+    def partition(self, *groups):
+        """
+        Splits the network so that only the nodes in the same group reach
+        each other.
+
+        Args:
+        groups (list): Lists of addresses.
+        """
+        self.groups = {address: number for number, group in enumerate(groups)
+                       for address in group}
+
+    def heal(self):
+        self.groups = None
+
+    def reachable(self, source, target):
+        return self.groups is None or self.groups.get(source) == self.groups.get(target)
+
+    def delay(self, source, target):
+        """
+        Returns the seconds a packet takes from the source to the target,
+        including the retransmissions of the lost packets. The packet
+        arrives after the ones sent before it on the same link.
+        """
+        link = self.link(source, target)
+        delay = link.uniform(*self.latency)
+        while self.loss and link.random() < self.loss:
+            self.retransmits += 1
+            delay += RETRANSMIT_DELAY
+        arrival = max(self.simulation.now + delay, self.arrivals.get((source, target), 0))
+        self.arrivals[(source, target)] = arrival
+        return arrival - self.simulation.now
+
+    def copy(self, data):
+        """
+        Passes a packet through the json encoding, so that the nodes never
+        share the objects they send.
+        """
+        if self.encoded[0] is not data:
+            self.encoded = (data, encode_packet(data))
+        payload = self.encoded[1]
+        self.bytes += len(payload)
+        return decode_packet(payload, ENCODING_JSON)
+
+    def send(self, source, target, data):
+        """
+        Sends a request that is answered after the delays of both
+        directions. Fails after REQUEST_TIMEOUT if the request or the
+        response runs into a partition, like a request over a connection
+        that stops getting through.
+
+        Returns:
+        Future: Resolves to the response packet.
+        """
+        self.requests += 1
+        future = Future()
+        deadline = self.simulation.now + REQUEST_TIMEOUT
+        delay = self.delay(source, target)
+        if self.reachable(source, target):
+            self.simulation.schedule(delay, self.receive, source, target, self.copy(data),
+                                     future, deadline)
+        else:
+            self.time_out(future, target, deadline)
+        return future
+
+    def receive(self, source, target, data, future, deadline):
+        node = self.nodes.get(target)
+        delay = self.delay(target, source)
+        if node is None or node.stopped:
+            self.simulation.schedule(delay, self.fail, future,
+                                     ConnectionRefusedError(f"Connection to {target} refused"))
+            return
+        response = self.copy(node.handle_request((source, 0), data) or {"type": "ERROR"})
+        if not self.reachable(target, source):
+            self.time_out(future, target, deadline)
+        elif self.simulation.now + delay > deadline:
+            self.time_out(future, target, deadline)
+        else:
+            self.simulation.schedule(delay, future.set_result, response)
+
+    def time_out(self, future, target, deadline):
+        self.simulation.schedule(deadline - self.simulation.now, self.fail, future,
+                                 FutureTimeoutError(f"Request to {target} timed out"))
+
+    @staticmethod
+    def fail(future, exc):
+        future.set_exception(exc)
+
+    def call(self, source, target, data):
+        """
+        Answers a request right away. Used for the requests that a node waits
+        for, like fetching the missing history or forwarding to the leader,
+        because nothing else could run in the simulation while the node
+        waits.
+
+        Raises:
+        ConnectionError: If the target is not reachable.
+        """
+        self.requests += 1
+        node = self.nodes.get(target)
+        if not self.reachable(source, target) or not self.reachable(target, source):
+            raise ConnectionError(f"Request to {target} timed out")
+        if node is None or node.stopped:
+            raise ConnectionRefusedError(f"Connection to {target} refused")
+        return self.copy(node.handle_request((source, 0), self.copy(data)) or {"type": "ERROR"})
+
+
+class SimulatedTransport:
+    """
+    Transport of one node through the simulated network.
+    """
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.closed = False
+
+    def submit(self, address, data):
+        if self.closed:
+            raise RuntimeError("Transport is closed")
+        return self.network.send(self.address, address, data)
+
+    def request(self, address, data):
+        if self.closed:
+            raise ConnectionError("Transport is closed")
+        return self.network.call(self.address, address, data)
+
+    def reset(self, address):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Cluster:
+    """
+    Simulated nodes that know each other from the start, and clients that
+    send messages to them at a fixed total rate.
+    """
+    def __init__(self, node_count, seed=0, latency=(0.001, 0.005), loss=0.0, leader_mode=False):
+        random.seed(seed)
+        self.simulation = Simulation()
+        self.network = Network(self.simulation, seed, latency, loss)
+        addresses = [(f"10.0.{i // 256}.{i % 256}:65412", f"node{i}") for i in range(node_count)]
+        self.addresses = [address for address, nickname in addresses]
+        self.nodes = []
+        for address, nickname in addresses:
+            scheduler = NodeScheduler(self.simulation)
+            node = Node([peer for peer in addresses if peer[1] != nickname], nickname,
+                        history_dir=None, headless=True, leader_mode=leader_mode,
+                        metrics_port=None,
+                        transport=SimulatedTransport(self.network, address),
+                        scheduler=scheduler, executor=scheduler, clock=self.simulation.clock)
+            self.network.nodes[address] = node
+            self.nodes.append(node)
+
+        # Send times of the messages that are not committed yet
+        self.sent = {}
+        self.latencies = []
+        # Messages not sent because the queue of the node was full
+        self.backlogged = 0
+        self.last_commit = None
+
+    def start(self):
+        for node in self.nodes:
+            node.subscribe(lambda entry, node=node: self.collect(node, entry))
+            # The heartbeats and the proposals of the nodes are spread over
+            # their intervals, like those of separately started nodes
+            node.scheduler.schedule(random.uniform(0, HEARTBEAT_INTERVAL), node.heartbeat)
+            node.scheduler.schedule(random.uniform(0, BATCH_DELAY), self.propose, node)
+
+    def propose(self, node):
+        """
+        Proposes the queued messages of a node every BATCH_DELAY, in place of
+        the proposer thread.
+        """
+        node.scheduler.schedule(BATCH_DELAY, self.propose, node)
+        for room in list(node.rooms.values()):
+            room.propose_queued()
+
+    def collect(self, node, entry):
+        if entry["sender"] != node.nickname:
+            return
+        sent = self.sent.pop(entry["message"], None)
+        if sent is not None:
+            self.latencies.append(self.simulation.now - sent)
+            self.last_commit = self.simulation.now
+
+    def client(self, node, interval, stop, sequence=0):
+        """
+        Sends a message to a node every interval until stop.
+        """
+        if self.simulation.now >= stop or node.stopped:
+            return
+        room = node.rooms[DEFAULT_ROOM]
+        if room.outbound_queue.limit and room.outbound_queue.qsize() >= room.outbound_queue.limit:
+            self.backlogged += 1
+        else:
+            message = f"{node.nickname}-{sequence}"
+            self.sent[message] = self.simulation.now
+            node.send(message)
+        self.simulation.schedule(interval, self.client, node, interval, stop, sequence + 1)
+
+    def crash(self, count):
+        """
+        Stops the last count nodes.
+        """
+        for node in self.nodes[len(self.nodes) - count:]:
+            node.stop()
+
+    def live_nodes(self):
+        return [node for node in self.nodes if not node.stopped]
+
+    def converged(self):
+        """
+        Whether the live nodes have committed everything they were sent and
+        have the same history.
+        """
+        rooms = [node.rooms[DEFAULT_ROOM] for node in self.live_nodes()]
+        if any(room.proposals or room.outbound_queue.qsize() for room in rooms):
+            return False
+        return len({room.next_message_index for room in rooms}) == 1
+
+    def consistent(self):
+        """
+        Whether the histories of the live nodes agree. A node that is behind
+        must have the beginning of the longest history.
+        """
+        histories = sorted((tuple((entry["sender"], entry["message"])
+                                  for entry in node.rooms[DEFAULT_ROOM].history)
+                            for node in self.live_nodes()), key=len)
+        return all(history == histories[-1][:len(history)] for history in histories)
+
+    def run(self, rate, duration, partition=None, crash=0, drain_timeout=30):
+        """
+        Sends messages at the given total rate for duration seconds of
+        simulated time, and runs until the nodes converge.
+
+        Args:
+        partition (tuple): Start time and length of a partition that cuts a
+            third of the nodes off from the rest.
+        crash (int): Number of nodes stopped in the middle of the run.
+        """
+        self.start()
+        live = self.nodes[:len(self.nodes) - crash]
+        for position, node in enumerate(live):
+            interval = len(live) / rate
+            self.simulation.schedule(interval * position / len(live), self.client, node, interval,
+                                     duration)
+        if partition:
+            minority = self.addresses[:len(self.addresses) // 3]
+            majority = self.addresses[len(self.addresses) // 3:]
+            self.simulation.schedule(partition[0], self.network.partition, minority, majority)
+            self.simulation.schedule(partition[0] + partition[1], self.network.heal)
+        if crash:
+            self.simulation.schedule(duration / 2, self.crash, crash)
+
+        self.simulation.run(duration)
+        converged_at = None
+        while self.simulation.now < duration + drain_timeout:
+            self.simulation.run(self.simulation.now + 0.01)
+            if not self.sent and self.converged():
+                converged_at = self.simulation.now
+                break
+        return self.report(rate, duration, converged_at)
+
+    def report(self, rate, duration, converged_at):
+        latencies = sorted(self.latencies)
+
+        def percentile(value):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * value))] * 1000, 3)
+
+        stats = {}
+        for node in self.nodes:
+            for name, value in node.stats.items():
+                stats[name] = stats.get(name, 0) + value
+        elapsed = self.last_commit or self.simulation.now
+        return {
+            "nodes": len(self.nodes),
+            "target_rate": rate,
+            "duration": duration,
+            "committed": len(latencies),
+            "uncommitted": len(self.sent),
+            "backlogged": self.backlogged,
+            "messages_per_second": round(len(latencies) / elapsed, 3) if elapsed > 0 else None,
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p90": percentile(0.9),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1] * 1000, 3) if latencies else None,
+            },
+            "converged": converged_at is not None,
+            "convergence_seconds": (round(converged_at - duration, 3)
+                                    if converged_at is not None else None),
+            "consistent": self.consistent(),
+            "proposals": stats.get("proposals", 0),
+            "forwarded": stats.get("forwarded", 0),
+            "rejected": stats.get("rejected", 0),
+            "retries": stats.get("retries", 0),
+            "requests": self.network.requests,
+            "retransmits": self.network.retransmits,
+            "bytes": self.network.bytes,
+            "errors": self.simulation.errors,
+        }
+
+
+def parse_range(value):
+    low, _, high = value.partition(",")
+    return float(low) / 1000, float(high or low) / 1000
+
+
+def parse_partition(value):
+    start, _, length = value.partition(",")
+    return float(start), float(length)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Simulate a cluster of nodes in one process.")
+    parser.add_argument("--nodes", default="3,10,50",
+                        help="comma separated cluster sizes, each one is simulated in turn")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="messages per second sent to all nodes together")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="simulated seconds to send messages")
+    parser.add_argument("--latency", type=parse_range, default=(0.001, 0.005), metavar="MIN,MAX",
+                        help="range of one-way network delays in milliseconds")
+    parser.add_argument("--loss", type=float, default=0,
+                        help="probability that a packet is lost and sent again")
+    parser.add_argument("--partition", type=parse_partition, metavar="START,LENGTH",
+                        help="cut a third of the nodes off from the rest for a while")
+    parser.add_argument("--crash", type=int, default=0,
+                        help="number of nodes stopped in the middle of the run")
+    parser.add_argument("--leader", action="store_true",
+                        help="propose through an elected leader of the nodes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random choices")
+    parser.add_argument("--json", metavar="FILE", help="write the results as json to FILE, - for stdout")
+    options = parser.parse_args(args[1:])
+
+    # Debug logging of every packet would dominate the run time
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    for node_count in [int(count) for count in options.nodes.split(",")]:
+        cluster = Cluster(node_count, options.seed, options.latency, options.loss, options.leader)
+        results.append(cluster.run(options.rate, options.duration, options.partition,
+                                   options.crash))
+        if options.json != "-":
+            result = results[-1]
+            latency = result["latency_ms"]
+            print(f"{node_count} nodes: committed {result['committed']}, "
+                  f"{result['uncommitted']} not committed, "
+                  f"{result['messages_per_second']} messages/s")
+            print(f"  Latency ms: p50 {latency['p50']}, p90 {latency['p90']}, "
+                  f"p99 {latency['p99']}, max {latency['max']}")
+            print(f"  Converged {result['convergence_seconds']}s after the load, "
+                  f"consistent {result['consistent']}")
+            print(f"  Proposals: {result['proposals']}, rejected {result['rejected']}, "
+                  f"retries {result['retries']}, forwarded {result['forwarded']}, "
+                  f"requests {result['requests']}, "
+                  f"retransmits {result['retransmits']}")
+
+    if options.json == "-":
+        print(json.dumps(results, indent=2))
+    elif options.json:
+        with open(options.json, "w") as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,4 +1,993 @@
+import io
+import os
+import queue
+import random
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+
+import main
+import simulator
+
+# Threads and iterations of the stress tests
+THREADS = 16
+ITERATIONS = 2000
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def hammer(function, threads=THREADS):
+    """
+    Runs function(thread_number) in many threads at once and fails if any
+    of them raised.
+    """
+    errors = []
+    start = threading.Barrier(threads)
+
+    def run(number):
+        try:
+            start.wait()
+            function(number)
+        except Exception as exc:
+            errors.append(exc)
+
+    workers = [threading.Thread(target=run, args=[number]) for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+
+
+class PeerTransport:
+    """
+    Hands the requests straight to the other nodes, keyed by address.
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.requests = []
+
+    def request(self, address, data, timeout=None):
+        self.requests.append(data)
+        return self.nodes[address].handle_request(("127.0.0.1", 0), data)
+
+    def reset(self, address):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueuedExecutor:
+    """
+    Keeps the submitted tasks until the test runs them.
+    """
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, function, *args):
+        self.tasks.append((function, args))
+
+    def run(self):
+        while self.tasks:
+            function, args = self.tasks.pop(0)
+            function(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class TestSegmentedLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open_log(self, **kwargs):
+        log = main.SegmentedLog(self.path, fsync="never", **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def fill(self, log, count, start=0):
+        for index in range(start, start + count):
+            log.append(index, "sender", f"message {index}", f"sender/1/{index}")
+
+    def test_append_and_read(self):
+        log = self.open_log()
+        self.fill(log, 10)
+        self.assertEqual(len(log), 10)
+        self.assertEqual(log.get(3), {"index": 3, "sender": "sender",
+                                      "message": "message 3", "id": "sender/1/3"})
+        self.assertEqual([entry["index"] for entry in log.read(8, 5)], [8, 9])
+        self.assertIsNone(log.get(10))
+
+    def test_append_out_of_order(self):
+        log = self.open_log()
+        with self.assertRaises(ValueError):
+            log.append(1, "sender", "message")
+
+    def test_reopen_continues(self):
+        log = self.open_log(segment_size=200)
+        self.fill(log, 50)
+        log.close()
+        log = self.open_log(segment_size=200)
+        self.assertEqual((log.first_index, log.next_index), (0, 50))
+        self.fill(log, 5, start=50)
+        self.assertEqual([entry["index"] for entry in log], list(range(55)))
+
+    def test_recover_partial_record(self):
+        log = self.open_log()
+        self.fill(log, 5)
+        log.close()
+        # A crash in the middle of writing the last record
+        log_path = os.path.join(self.path, f"{0:020d}.log")
+        with open(log_path, "r+b") as file:
+            file.truncate(os.path.getsize(log_path) - 3)
+        log = self.open_log()
+        self.assertEqual(log.next_index, 4)
+        self.fill(log, 1, start=4)
+        self.assertEqual(log.get(4)["message"], "message 4")
+
+    def test_recover_missing_index_entries(self):
+        log = self.open_log()
+        self.fill(log, 5)
+        log.close()
+        # The records were written but the index entries of the last two
+        # were not
+        index_path = os.path.join(self.path, f"{0:020d}.idx")
+        with open(index_path, "r+b") as file:
+            file.truncate(3 * main.INDEX_ENTRY.size)
+        log = self.open_log()
+        self.assertEqual(log.next_index, 5)
+        self.assertEqual(log.get(4)["message"], "message 4")
+
+    def test_compact_keeps_the_last_segment(self):
+        log = self.open_log(segment_size=100)
+        self.fill(log, 40)
+        segments = len(log.segments)
+        self.assertGreater(segments, 2)
+        log.compact(count=5)
+        self.assertEqual(log.next_index, 40)
+        self.assertGreaterEqual(len(log), 5)
+        self.assertLess(len(log.segments), segments)
+        self.assertIsNone(log.get(0))
+        self.assertEqual(log.get(39)["index"], 39)
+        log.compact(count=1)
+        self.assertEqual(len(log.segments), 1)
+
+    def test_reset(self):
+        log = self.open_log()
+        self.fill(log, 5)
+        log.reset(100)
+        self.assertEqual((log.first_index, log.next_index), (100, 100))
+        self.fill(log, 1, start=100)
+        log.close()
+        log = self.open_log()
+        self.assertEqual((log.first_index, log.next_index), (100, 101))
+
+    def test_snapshot(self):
+        log = self.open_log()
+        self.assertIsNone(log.load_snapshot())
+        log.save_snapshot({"next_index": 3, "messages": []})
+        self.assertEqual(log.load_snapshot()["next_index"], 3)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = main.Scheduler()
+        self.addCleanup(self.scheduler.stop)
+
+    def test_runs_in_deadline_order(self):
+        calls = []
+        done = threading.Event()
+        self.scheduler.schedule(0.03, calls.append, 3)
+        self.scheduler.schedule(0.01, calls.append, 1)
+        self.scheduler.schedule(0.02, calls.append, 2)
+        self.scheduler.schedule(0.04, done.set)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(calls, [1, 2, 3])
+
+    def test_cancel(self):
+        calls = []
+        done = threading.Event()
+        self.scheduler.schedule(0.01, calls.append, 1).cancel()
+        self.scheduler.schedule(0.02, done.set)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(calls, [])
+
+    def test_failing_call_doesnt_stop_the_thread(self):
+        done = threading.Event()
+        self.scheduler.schedule(0, lambda: 1 / 0)
+        self.scheduler.schedule(0.01, done.set)
+        self.assertTrue(done.wait(2))
+
+    def test_stop(self):
+        calls = []
+        self.scheduler.schedule(0.01, calls.append, 1)
+        self.scheduler.stop()
+        self.scheduler.schedule(0, calls.append, 2)
+        time.sleep(0.05)
+        self.assertEqual(calls, [])
+
+    def test_schedule_from_many_threads(self):
+        calls = []
+        lock = threading.Lock()
+
+        def record(number):
+            with lock:
+                calls.append(number)
+
+        hammer(lambda thread: [self.scheduler.schedule(random.uniform(0, 0.05), record,
+                                                       thread * 100 + i)
+                               for i in range(100)])
+        deadline = time.monotonic() + 5
+        while len(calls) < THREADS * 100 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(calls), list(range(THREADS * 100)))
+
+
+class TestBoundedQueue(unittest.TestCase):
+    def test_block(self):
+        items = main.BoundedQueue(2, "block")
+        items.put(1)
+        items.put(2)
+        with self.assertRaises(queue.Full):
+            items.put_nowait(3)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            main.BoundedQueue(2, "shuffle")
+
+    def test_drop_oldest(self):
+        dropped = []
+        items = main.BoundedQueue(2, "drop-oldest", on_drop=dropped.append)
+        for item in range(4):
+            items.put(item)
+        self.assertEqual([items.get(), items.get()], [2, 3])
+        self.assertEqual(dropped, [0, 1])
+
+    def test_coalesce_batches(self):
+        items = main.BoundedQueue(1, "coalesce", merge=main.coalesce_batches)
+        items.put((["a"], ["one"], ["a/1"]))
+        items.put((["b"], ["two"], ["b/1"]))
+        self.assertEqual(items.qsize(), 1)
+        self.assertEqual(items.get(), (["a", "b"], ["one", "two"], ["a/1", "b/1"]))
+
+    def test_coalesce_falls_back_to_dropping(self):
+        dropped = []
+        items = main.BoundedQueue(1, "coalesce", merge=main.coalesce_events,
+                                  on_drop=dropped.append)
+        items.put({"type": "resize"})
+        items.put({"type": "resize"})
+        self.assertEqual(dropped, [])
+        items.put({"type": "info"})
+        self.assertEqual(dropped, [{"type": "resize"}])
+
+    def test_stop_sentinel_is_not_merged(self):
+        items = main.BoundedQueue(1, "coalesce", merge=main.coalesce_batches)
+        items.put((["a"], ["one"], ["a/1"]))
+        items.put(None)
+        self.assertIsNone(items.get())
+
+    def test_drop_oldest_from_many_threads(self):
+        dropped = []
+        items = main.BoundedQueue(50, "drop-oldest", on_drop=dropped.append)
+        hammer(lambda thread: [items.put((thread, i)) for i in range(ITERATIONS)])
+        self.assertEqual(items.qsize(), 50)
+        self.assertEqual(len(dropped) + items.qsize(), THREADS * ITERATIONS)
+
+
+class TestMessageIds(unittest.TestCase):
+    def test_duplicates(self):
+        ids = main.MessageIds(3)
+        self.assertTrue(ids.add("a"))
+        self.assertFalse(ids.add("a"))
+        self.assertIn("a", ids)
+        self.assertEqual(len(ids), 1)
+
+    def test_forgets_the_oldest(self):
+        ids = main.MessageIds(3)
+        for message_id in "abcd":
+            ids.add(message_id)
+        self.assertNotIn("a", ids)
+        self.assertEqual([message_id in ids for message_id in "bcd"], [True] * 3)
+        self.assertEqual(len(ids), 3)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = main.RateLimiter(10, self.clock)
+
+    def test_allow_and_charge(self):
+        self.assertTrue(self.limiter.allow(["a"] * 10))
+        self.limiter.charge(["a"] * 10)
+        self.assertFalse(self.limiter.allow(["a"]))
+        self.assertTrue(self.limiter.allow(["b"]))
+
+    def test_refill(self):
+        self.limiter.charge(["a"] * 10)
+        self.clock.now += 0.5
+        self.assertTrue(self.limiter.allow(["a"] * 5))
+        self.assertFalse(self.limiter.allow(["a"] * 6))
+        self.clock.now += 100
+        self.assertEqual(self.limiter.tokens("a", self.clock.now), 10)
+
+    def test_large_batch_from_a_full_bucket(self):
+        self.assertTrue(self.limiter.allow(["a"] * 25))
+        self.limiter.charge(["a"] * 25)
+        self.clock.now += 1
+        self.assertFalse(self.limiter.allow(["a"]))
+
+    def test_only_allow_doesnt_charge(self):
+        for _ in range(100):
+            self.assertTrue(self.limiter.allow(["a"] * 10))
+
+    def test_charge_from_many_threads(self):
+        limiter = main.RateLimiter(1e9, self.clock)
+        hammer(lambda thread: [limiter.charge(["a"]) for _ in range(ITERATIONS)])
+        self.assertEqual(limiter.tokens("a", self.clock.now), 1e9 - THREADS * ITERATIONS)
+
+
+class TestMembership(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(100.0)
+        self.changes = []
+        self.membership = main.Membership(
+            "me", on_change=lambda *change: self.changes.append(change), clock=self.clock)
+        self.membership.add("peer:1", "peer", incarnation=1)
+
+    def status(self, nickname="peer"):
+        return self.membership.members[nickname].status
+
+    def gossip(self, nickname="peer", incarnation=1, status=main.ALIVE):
+        return {"address": f"{nickname}:1", "nickname": nickname, "incarnation": incarnation,
+                "status": status, "rooms": [main.DEFAULT_ROOM]}
+
+    def test_merge(self):
+        self.membership.merge([self.gossip(status=main.SUSPECT)])
+        self.assertEqual(self.status(), main.SUSPECT)
+        # On the same or an older incarnation the more severe state wins
+        self.membership.merge([self.gossip(incarnation=0), self.gossip()])
+        self.assertEqual(self.status(), main.SUSPECT)
+        self.membership.merge([self.gossip(incarnation=2)])
+        self.assertEqual(self.status(), main.ALIVE)
+        self.assertEqual(self.membership.members["peer"].incarnation, 2)
+
+    def test_merge_doesnt_add_dead_members(self):
+        self.membership.merge([self.gossip("other"), self.gossip("gone", status=main.DEAD)])
+        self.assertEqual(self.membership.peers(), {("peer:1", "peer"), ("other:1", "other")})
+        self.assertNotIn("gone", self.membership.members)
+
+    def test_refute_suspicion(self):
+        incarnation = self.membership.incarnation
+        self.membership.merge([self.gossip("me", incarnation, main.SUSPECT)])
+        self.assertEqual(self.membership.incarnation, incarnation + 1)
+        # The claim about the refuted incarnation is old news
+        self.membership.merge([self.gossip("me", incarnation, main.DEAD)])
+        self.assertEqual(self.membership.incarnation, incarnation + 1)
+        self.assertNotIn("me", self.membership.members)
+
+    def test_suspect_then_dead(self):
+        self.assertEqual(self.membership.check(), [("peer:1", "peer")])
+        self.clock.now += 10
+        self.membership.check()
+        self.assertEqual(self.status(), main.SUSPECT)
+        # Gossip can't revive a member that doesn't answer our heartbeats
+        self.membership.merge([self.gossip(incarnation=2)])
+        self.assertEqual(self.status(), main.SUSPECT)
+        self.clock.now += main.SUSPECT_TIMEOUT + 1
+        self.membership.check()
+        self.assertEqual(self.status(), main.DEAD)
+        self.assertEqual(self.membership.peers(), frozenset())
+        self.assertEqual([change[1:] for change in self.changes],
+                         [(main.ALIVE, main.SUSPECT), (main.SUSPECT, main.DEAD)])
+        # A response to a heartbeat proves it is alive again
+        self.membership.refresh("peer", 2, heartbeat=True)
+        self.assertEqual(self.status(), main.ALIVE)
+
+    def test_dead_members_are_forgotten(self):
+        self.membership.failed("peer", dead=True)
+        self.clock.now += main.DEAD_MEMBER_RETAIN + 1
+        self.membership.check()
+        self.assertNotIn("peer", self.membership.members)
+
+
+class TestProposal(unittest.TestCase):
+    def start(self, peer_count):
+        proposal = main.Proposal(["hello"], ["me"], ["me/1/0"])
+        proposal.start_round(0, "me/0", peer_count)
+        return proposal
+
+    def test_accepted_by_majority(self):
+        proposal = self.start(4)
+        self.assertFalse(proposal.add_vote("ack"))
+        self.assertFalse(proposal.add_vote("ack"))
+        self.assertTrue(proposal.add_vote("ack"))
+        self.assertTrue(proposal.accepted)
+
+    def test_rejected_once_majority_is_impossible(self):
+        proposal = self.start(4)
+        self.assertFalse(proposal.add_vote("reject"))
+        self.assertTrue(proposal.add_vote("reject"))
+        self.assertIs(proposal.accepted, False)
+
+    def test_missing_votes_count_against(self):
+        proposal = self.start(3)
+        proposal.add_vote("ack")
+        self.assertFalse(proposal.add_vote(None))
+        self.assertTrue(proposal.add_vote(None))
+        self.assertIs(proposal.accepted, False)
+
+    def test_no_peers(self):
+        self.assertTrue(self.start(0).decide())
+
+    def test_drop_committed(self):
+        proposal = main.Proposal(["one", "two"], ["a", "b"], ["a/1/0", "b/1/0"])
+        self.assertTrue(proposal.drop_committed({"a/1/0"}))
+        self.assertEqual((proposal.messages, proposal.senders, proposal.ids),
+                         (["two"], ["b"], ["b/1/0"]))
+        self.assertFalse(proposal.drop_committed({"b/1/0"}))
+
+
+class TestScrollback(unittest.TestCase):
+    @staticmethod
+    def wrap(text, width):
+        return [text[i:i + width] for i in range(0, len(text), width)] or [""]
+
+    def test_line_count_follows_adds_drops_and_resizes(self):
+        scrollback = main.Scrollback(20)
+        for i in range(100):
+            scrollback.add(self.wrap, "x" * random.randint(0, 100))
+            width = random.choice([10, 30, 80])
+            self.assertEqual(scrollback.line_count(width),
+                             sum(len(entry.wrap(width)) for entry in scrollback.entries))
+
+    def test_lines(self):
+        scrollback = main.Scrollback()
+        for text in ("aaaa", "bb", "cccccc"):
+            scrollback.add(self.wrap, text)
+        self.assertEqual(scrollback.lines(3, 2), ["ccc", "ccc"])
+        self.assertEqual(scrollback.lines(3, 2, scroll=2), ["a", "bb"])
+
+
+class TestUserInterfaceKeys(unittest.TestCase):
+    def setUp(self):
+        self.events = queue.Queue()
+        self.ui = main.UserInterface(self.events, lambda message: None, "me")
+        self.ui.size = os.terminal_size((10, 7))
+
+    def test_escape_sequences(self):
+        self.assertEqual(main.read_escape_sequence(io.StringIO("[A").read), ("up", None))
+        self.assertEqual(main.read_escape_sequence(io.StringIO("OD").read), ("left", None))
+        self.assertEqual(main.read_escape_sequence(io.StringIO("[5~").read), ("page_up", None))
+        # Ctrl-right isn't handled, but is read whole
+        read = io.StringIO("[1;5Cx").read
+        self.assertEqual(main.read_escape_sequence(read), (None, None))
+        self.assertEqual(read(1), "x")
+        self.assertEqual(main.read_escape_sequence(io.StringIO("x").read), (None, "x"))
+
+    def test_one_event_per_key(self):
+        with mock.patch.object(main.sys, "stdin", io.StringIO("a\033[A\033[6~b")):
+            self.ui.run_input_listener()
+        events = []
+        while not self.events.empty():
+            events.append(self.events.get())
+        self.assertEqual(events, [{"type": "input", "char": "a"},
+                                  {"type": "key", "name": "up"},
+                                  {"type": "key", "name": "page_down"},
+                                  {"type": "input", "char": "b"},
+                                  # End of the input exits like ctrl-d
+                                  {"type": "input", "char": "\x04"}])
+
+    def test_scroll_keys(self):
+        for i in range(20):
+            self.ui.handle_event({"type": "info", "content": f"line {i}"})
+        # Five message lines above the footer
+        for name, scroll in (("page_up", 5), ("up", 6), ("page_down", 1), ("down", 0),
+                             ("down", 0)):
+            self.ui.handle_event({"type": "key", "name": name})
+            self.assertEqual(self.ui.scroll, scroll)
+
+    def test_cursor_keys(self):
+        for char in "ab":
+            self.ui.handle_event({"type": "input", "char": char})
+        self.ui.handle_event({"type": "key", "name": "left"})
+        self.assertEqual(self.ui.cursor, 1)
+        self.ui.handle_event({"type": "key", "name": "right"})
+        self.ui.handle_event({"type": "key", "name": "right"})
+        self.assertEqual(self.ui.cursor, 2)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_count_from_many_threads(self):
+        metrics = main.Metrics()
+        metrics.histogram("seconds")
+
+        def work(thread):
+            for i in range(ITERATIONS):
+                metrics.count("requests")
+                metrics.count("bytes", 10)
+                metrics.observe("seconds", i / ITERATIONS)
+                if i % 100 == 0:
+                    metrics.snapshot()
+                    metrics.prometheus()
+
+        hammer(work)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["requests"], THREADS * ITERATIONS)
+        self.assertEqual(snapshot["counters"]["bytes"], THREADS * ITERATIONS * 10)
+        self.assertEqual(snapshot["histograms"]["seconds"]["count"], THREADS * ITERATIONS)
+
+
+class TestRoomStress(unittest.TestCase):
+    def setUp(self):
+        self.node = main.Node([], "me", history_dir=None, headless=True, metrics_port=None)
+        self.addCleanup(self.node.stop)
+        self.room = self.node.rooms[main.DEFAULT_ROOM]
+
+    def test_commits_from_many_threads(self):
+        batch_size = 3
+        batches = THREADS * 50
+        order = list(range(batches))
+        random.shuffle(order)
+        delivered = []
+        self.node.subscribe(lambda entry: delivered.append(entry["index"]))
+
+        def commit(thread):
+            for batch in order[thread::THREADS]:
+                index = batch * batch_size
+                self.room.handle_request(("127.0.0.1", 0), {
+                    "type": "COMMIT", "room": main.DEFAULT_ROOM, "index": index,
+                    "sender": f"peer{batch % 3}",
+                    "messages": [f"message {index + i}" for i in range(batch_size)],
+                    "ids": [f"peer/1/{index + i}" for i in range(batch_size)]})
+
+        hammer(commit)
+        total = batches * batch_size
+        self.assertEqual(delivered, list(range(total)))
+        self.assertEqual([entry["index"] for entry in self.room.history.read(0, total)],
+                         list(range(total)))
+        self.assertEqual(self.room.commits_ahead, {})
+
+    def test_duplicate_commits_are_delivered_once(self):
+        delivered = []
+        self.node.subscribe(lambda entry: delivered.append(entry["id"]))
+
+        def commit(thread):
+            for index in range(200):
+                self.room.handle_request(("127.0.0.1", 0), {
+                    "type": "COMMIT", "room": main.DEFAULT_ROOM, "index": index,
+                    "sender": "peer", "messages": [f"message {index}"],
+                    "ids": [f"peer/1/{index}"]})
+
+        hammer(commit)
+        self.assertEqual(delivered, [f"peer/1/{index}" for index in range(200)])
+
+    def test_subscribe_while_delivering(self):
+        stop = threading.Event()
+
+        def churn(thread):
+            if thread == 0:
+                for index in range(ITERATIONS):
+                    with self.room.lock:
+                        self.room.apply_commit(index, "peer", [f"message {index}"])
+                stop.set()
+                return
+            callback = lambda entry: None
+            while not stop.is_set():
+                self.node.subscribe(callback)
+                self.node.unsubscribe(callback)
+
+        hammer(churn, threads=4)
+        self.assertEqual(self.room.next_message_index, ITERATIONS)
+        self.assertEqual(self.node.subscribers, [])
+
+    def test_no_proposal_over_an_acked_batch(self):
+        response = self.room.handle_request(("127.0.0.1", 0), {
+            "type": "PROPOSE", "room": main.DEFAULT_ROOM, "index": 0, "proposal": "peer/0",
+            "sender": "peer", "messages": ["theirs"]})
+        self.assertEqual(response["value"], "ack")
+        with self.room.lock:
+            self.room.add_proposal(["me"], ["mine"], [None])
+            self.assertIsNone(self.room.proposals[0].index)
+            self.assertEqual(self.room.pending_other[0][0], "peer/0")
+            self.assertIsNotNone(self.room.retry_timer)
+
+    def test_commit_after_a_gap_behind_pending_batches(self):
+        with self.room.lock:
+            self.room.set_pending_message(0, "peer/0", ["pending"])
+            # The batch right after the pending one fills the gap
+            self.assertFalse(self.room.apply_commit(1, "peer", ["next"]))
+            # Nobody has a batch pending at 2 or 3
+            self.assertTrue(self.room.apply_commit(4, "peer", ["later"]))
+
+
+class TestHistoryFetch(unittest.TestCase):
+    def setUp(self):
+        self.peer = self.node("peer", [])
+        self.peer_room = self.peer.rooms[main.DEFAULT_ROOM]
+        with self.peer_room.lock:
+            for index in range(10):
+                self.peer_room.apply_commit(index, "peer", [f"message {index}"])
+        self.transport = PeerTransport({"peer:1": self.peer})
+        self.executor = QueuedExecutor()
+        self.me = self.node("me", [("peer:1", "peer")], transport=self.transport,
+                            executor=self.executor)
+        self.room = self.me.rooms[main.DEFAULT_ROOM]
+
+    def node(self, nickname, hosts, **kwargs):
+        node = main.Node(hosts, nickname, history_dir=None, headless=True, metrics_port=None,
+                         **kwargs)
+        self.addCleanup(node.stop)
+        return node
+
+    def commit(self, index):
+        return self.room.handle_request(("127.0.0.1", 0), {
+            "type": "COMMIT", "room": main.DEFAULT_ROOM, "index": index, "sender": "peer",
+            "messages": [f"message {index}"]})
+
+    def history(self, room):
+        return [(entry["index"], entry["message"])
+                for entry in room.history.read(0, room.history.next_index)]
+
+    def test_paged_history(self):
+        with mock.patch.object(main, "HISTORY_PAGE_SIZE", 4):
+            self.room.catch_up()
+        self.assertEqual(self.history(self.room), self.history(self.peer_room))
+        self.assertEqual([request["from_index"] for request in self.transport.requests],
+                         [0, 4, 8])
+
+    def test_snapshot_when_the_peer_has_compacted(self):
+        with mock.patch.multiple(main, SNAPSHOT_MESSAGES=3, HISTORY_RETAIN_COUNT=3), \
+                self.peer_room.lock:
+            self.peer_room.take_snapshot()
+            for index in range(10, 12):
+                self.peer_room.apply_commit(index, "peer", [f"message {index}"])
+        self.assertEqual(self.peer_room.history.first_index, 7)
+        self.room.catch_up()
+        self.assertEqual(self.history(self.room), self.history(self.peer_room))
+        self.assertEqual([request["type"] for request in self.transport.requests],
+                         ["GET_HISTORY", "GET_SNAPSHOT", "GET_HISTORY"])
+        self.assertEqual(self.room.next_message_index, 12)
+
+    def test_commit_after_a_gap_is_acked_before_the_fetch(self):
+        self.assertEqual(self.commit(8)["type"], "ACK_COMMIT")
+        self.assertEqual(self.commit(9)["type"], "ACK_COMMIT")
+        self.assertEqual(self.transport.requests, [])
+        # The second gap joins the fetch that is already on its way
+        self.assertEqual(len(self.executor.tasks), 1)
+        self.executor.run()
+        self.assertEqual(self.history(self.room), self.history(self.peer_room))
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertFalse(self.room.fetching)
+        self.assertEqual(self.room.commits_ahead, {})
+
+
+class TestRooms(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.node = self.start_node()
+        self.node.membership.add("alice:1", "alice", rooms=[main.DEFAULT_ROOM, "games"])
+        self.node.membership.add("bob:1", "bob")
+        self.games = self.node.join_room("games")
+
+    def start_node(self):
+        node = main.Node([], "me", history_dir=self.directory.name, headless=True,
+                         metrics_port=None)
+        self.addCleanup(node.stop)
+        return node
+
+    def commit(self, room, index, message):
+        return self.node.handle_request(("127.0.0.1", 0), {
+            "type": "COMMIT", "room": room, "index": index, "sender": "alice",
+            "messages": [message]})
+
+    def test_members_of_each_room(self):
+        self.assertEqual(self.games.peer_hosts, {("alice:1", "alice")})
+        self.assertEqual(self.node.rooms[main.DEFAULT_ROOM].peer_hosts,
+                         {("alice:1", "alice"), ("bob:1", "bob")})
+
+    def test_commits_stay_in_their_room(self):
+        delivered = []
+        self.node.subscribe(lambda entry: delivered.append((entry["room"], entry["message"])))
+        self.commit("games", 0, "move")
+        self.commit(main.DEFAULT_ROOM, 0, "hello")
+        self.commit(main.DEFAULT_ROOM, 1, "again")
+        self.assertEqual(delivered, [("games", "move"), (main.DEFAULT_ROOM, "hello"),
+                                     (main.DEFAULT_ROOM, "again")])
+        self.assertEqual([entry["message"] for entry in self.games.history], ["move"])
+        self.assertEqual(self.node.rooms[main.DEFAULT_ROOM].next_message_index, 2)
+
+    def test_requests_for_other_rooms(self):
+        response = self.node.handle_request(("127.0.0.1", 0), {
+            "type": "PROPOSE", "room": "other", "index": 0, "proposal": "alice/0",
+            "sender": "alice", "messages": ["hi"]})
+        self.assertEqual(response["value"], "reject")
+        self.assertIsNone(self.commit("other", 0, "hi"))
+        self.assertNotIn("other", self.node.rooms)
+        with self.assertRaises(ValueError):
+            self.node.join_room("../other")
+
+    def test_rooms_are_rejoined_after_a_restart(self):
+        self.commit("games", 0, "move")
+        self.node.stop()
+        node = self.start_node()
+        self.assertEqual(sorted(node.rooms), ["games", main.DEFAULT_ROOM])
+        self.assertEqual([entry["message"] for entry in node.rooms["games"].history], ["move"])
+        self.assertEqual(node.rooms[main.DEFAULT_ROOM].next_message_index, 0)
+
+
+class TestLeaderMode(unittest.TestCase):
+    def setUp(self):
+        self.cluster = simulator.Cluster(3, seed=1, leader_mode=True)
+        self.cluster.start()
+        self.run_for(5)
+
+    def run_for(self, seconds):
+        self.cluster.simulation.run(self.cluster.simulation.now + seconds)
+
+    def rooms(self):
+        return [node.rooms[main.DEFAULT_ROOM] for node in self.cluster.live_nodes()]
+
+    def leader(self):
+        leaders = {(room.term, room.leader) for room in self.rooms()}
+        self.assertEqual(len(leaders), 1)
+        term, leader = leaders.pop()
+        self.assertIsNotNone(leader)
+        return term, leader
+
+    def test_vote_once_per_term(self):
+        room = self.rooms()[0]
+        term = room.term + 1
+
+        def request_vote(candidate, next_index):
+            return room.handle_request(("127.0.0.1", 0), {
+                "type": "REQUEST_VOTE", "room": main.DEFAULT_ROOM, "term": term,
+                "candidate": candidate, "next_index": next_index})["granted"]
+
+        room.next_message_index = 5
+        # A candidate without all of our batches can't lead
+        self.assertFalse(request_vote("a", 4))
+        self.assertTrue(request_vote("b", 5))
+        self.assertTrue(request_vote("b", 5))
+        self.assertFalse(request_vote("c", 5))
+
+    def test_followers_forward_to_the_leader(self):
+        term, leader = self.leader()
+        followers = [node for node in self.cluster.nodes if node.nickname != leader]
+        for node in followers:
+            node.send(f"hello from {node.nickname}")
+        self.run_for(2)
+        for room in self.rooms():
+            self.assertEqual(sorted(entry["message"] for entry in room.history),
+                             sorted(f"hello from {node.nickname}" for node in followers))
+            # Only the leader proposes
+            if room.node.nickname != leader:
+                self.assertEqual(room.node.stats.get("proposals", 0), 0)
+                self.assertEqual(room.node.stats["forwarded"], 1)
+        self.assertEqual(self.leader(), (term, leader))
+
+    def test_new_leader_after_the_leader_stops(self):
+        term, leader = self.leader()
+        next(node for node in self.cluster.nodes if node.nickname == leader).stop()
+        self.run_for(10)
+        new_term, new_leader = self.leader()
+        self.assertGreater(new_term, term)
+        self.assertNotEqual(new_leader, leader)
+
+
+class TestSimulator(unittest.TestCase):
+    def run_cluster(self, **kwargs):
+        cluster = simulator.Cluster(5, seed=3, loss=0.02, **kwargs)
+        return cluster.run(rate=200, duration=2, partition=(0.5, 1))
+
+    def test_converges_after_a_partition(self):
+        for leader_mode in (False, True):
+            result = self.run_cluster(leader_mode=leader_mode)
+            self.assertTrue(result["converged"])
+            self.assertTrue(result["consistent"])
+            self.assertEqual(result["uncommitted"], 0)
+            self.assertGreater(result["committed"], 0)
+            self.assertEqual(result["errors"], 0)
+
+    def test_same_seed_same_result(self):
+        self.assertEqual(self.run_cluster(), self.run_cluster())
+
+
+class TestNodeServer(unittest.TestCase):
+    def node(self, port):
+        node = main.Node([], "me", history_dir=None, port=port, bind_host="127.0.0.1",
+                         headless=True, metrics_port=None)
+        self.addCleanup(node.stop)
+        return node
+
+    def test_start_fails_if_the_port_is_taken(self):
+        for use_asyncio in (False, True):
+            with socket.create_server(("127.0.0.1", 0)) as taken:
+                node = self.node(taken.getsockname()[1])
+                with self.assertRaises(OSError):
+                    node.start(join=False, use_asyncio=use_asyncio)
+                self.assertTrue(node.stopped)
+
+    def test_asyncio_server(self):
+        with socket.create_server(("127.0.0.1", 0)) as free:
+            port = free.getsockname()[1]
+        node = self.node(port)
+        room = node.rooms[main.DEFAULT_ROOM]
+        with room.lock:
+            room.apply_commit(0, "peer", ["hello"])
+        threads = []
+        handle_request = room.handle_request
+
+        def record_thread(addr, message):
+            threads.append(threading.current_thread().name)
+            return handle_request(addr, message)
+
+        room.handle_request = record_thread
+        node.start(join=False, use_asyncio=True)
+        scheduler = main.Scheduler()
+        self.addCleanup(scheduler.stop)
+        transport = main.TcpTransport(scheduler=scheduler)
+        self.addCleanup(transport.close)
+        address = main.format_address("127.0.0.1", port)
+        self.assertEqual(transport.request(address, {"type": "STATS"})["type"], "STATS")
+        response = transport.request(address, {"type": "GET_HISTORY", "room": main.DEFAULT_ROOM,
+                                               "from_index": 0})
+        self.assertEqual([entry["message"] for entry in response["history"]], ["hello"])
+        response = transport.request(address, {"type": "PROPOSE", "room": main.DEFAULT_ROOM,
+                                               "index": 1, "proposal": "peer/0",
+                                               "sender": "peer", "messages": ["world"]})
+        self.assertEqual(response["value"], "ack")
+        # The room requests are handled off the event loop
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith("requests") for name in threads))
+
+    def test_stop_closes_the_port(self):
+        with socket.create_server(("127.0.0.1", 0)) as free:
+            port = free.getsockname()[1]
+        node = self.node(port).start(join=False)
+        socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        node.stop()
+        with self.assertRaises(ConnectionRefusedError):
+            socket.create_connection(("127.0.0.1", port), timeout=1)
+        # The thread blocked in accept has woken up
+        node.server_thread.join(1)
+        self.assertFalse(node.server_thread.is_alive())
+
+
+class TestPacketReader(unittest.TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.addCleanup(self.ours.close)
+        self.addCleanup(self.theirs.close)
+        self.metrics = main.Metrics()
+        self.reader = main.PacketReader(self.ours, self.metrics)
+        self.addCleanup(self.reader.close)
+
+    def send_slowly(self, data):
+        """
+        Sends the bytes a few at a time, so that the reader gets partial reads.
+        """
+        def send():
+            for start in range(0, len(data), 7):
+                self.theirs.sendall(data[start:start + 7])
+                time.sleep(0.0001)
+            self.theirs.shutdown(socket.SHUT_WR)
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_partial_reads(self):
+        packets = [{"type": "PING", "id": number} for number in range(20)]
+        self.send_slowly(b"".join(b"".join(main.frame_packet(packet)) for packet in packets))
+        self.assertEqual(list(self.reader), packets)
+
+    def test_large_frames(self):
+        packets = [{"type": "HISTORY", "history": ["x" * size]}
+                   for size in (1000, 5000, main.SMALL_FRAME_SIZE * 3)]
+        sender = threading.Thread(target=lambda: [main.send_packet(self.theirs, packet)
+                                                  for packet in packets])
+        sender.start()
+        self.assertEqual([self.reader.read() for _ in packets], packets)
+        sender.join()
+        self.assertEqual(self.metrics.counters["bytes_received"],
+                         sum(len(b"".join(main.frame_packet(packet))) for packet in packets))
+
+    @unittest.skipUnless(main.msgpack, "msgpack isn't installed")
+    def test_msgpack_frame(self):
+        packet = {"type": "COMMIT", "messages": ["x" * 2000]}
+        self.send_slowly(b"".join(main.frame_packet(packet, main.ENCODING_MSGPACK)))
+        self.assertEqual(self.reader.read(), packet)
+
+    def test_closed_in_the_middle_of_a_frame(self):
+        self.send_slowly(b"".join(main.frame_packet({"type": "PING"}))[:-3])
+        with self.assertRaises(ConnectionError):
+            self.reader.read()
+
+    def test_frame_over_the_limit(self):
+        self.theirs.sendall(main.FRAME_HEADER.pack(main.MAX_FRAME_SIZE + 1, main.ENCODING_JSON))
+        with self.assertRaises(ValueError):
+            self.reader.read()
+
+
+class TestPeerConnectionWindow(unittest.TestCase):
+    """
+    Requests over the send window wait in the connection instead of
+    failing it.
+    """
+    def setUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(self.server.close)
+        self.address = f"127.0.0.1:{self.server.getsockname()[1]}"
+        # Requests are answered once this is set
+        self.answer = threading.Event()
+        threading.Thread(target=self.serve, daemon=True).start()
+        patcher = mock.patch.object(main, "PEER_WINDOW", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.metrics = main.Metrics()
+        self.connection = main.PeerConnection(self.address, self.metrics)
+        self.addCleanup(self.connection.close)
+
+    def serve(self):
+        try:
+            connection, _ = self.server.accept()
+        except OSError:
+            return
+        with connection:
+            for request in main.read_packets(connection):
+                if request.get("hang"):
+                    continue
+                self.answer.wait()
+                main.send_packet(connection, {"type": "PONG", "id": request["id"]})
+
+    def test_waits_over_the_window(self):
+        futures = [self.connection.submit({"type": "PING"}) for _ in range(5)]
+        self.assertEqual(len(self.connection.pending), 2)
+        self.assertEqual(len(self.connection.waiting), 3)
+        self.assertEqual(self.metrics.counters["window_waits"], 3)
+        futures[4].cancel()
+        self.assertEqual(len(self.connection.waiting), 2)
+        self.answer.set()
+        for future in futures[:4]:
+            self.assertEqual(future.result(5)["type"], "PONG")
+        self.assertFalse(self.connection.closed)
+        self.assertEqual((self.connection.pending, self.connection.waiting), ({}, {}))
+
+    def test_cancelled_requests_free_the_window(self):
+        hung = [self.connection.submit({"type": "PING", "hang": True}) for _ in range(2)]
+        waiting = self.connection.submit({"type": "PING"})
+        self.assertEqual(len(self.connection.waiting), 1)
+        for future in hung:
+            future.cancel()
+        self.answer.set()
+        self.assertEqual(waiting.result(5)["type"], "PONG")
+        self.assertEqual(self.connection.pending, {})
+
+    def test_close_fails_waiting_requests(self):
+        futures = [self.connection.submit({"type": "PING"}) for _ in range(3)]
+        self.connection.close()
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                future.result(5)
+        with self.assertRaises(ConnectionError):
+            self.connection.submit({"type": "PING"})
+
 
 if __name__ == '__main__':
     unittest.main()